@@ -1,3 +1,11 @@
-from .mcmc import set_chain_size, set_walker_size, set_initial_positions, prior_dict, set_prior_bounds, log_prior, log_likelihood, log_posterior
-from .vis import plot_samples, print_stats
-from .models import load_ssp_cube, load_ionization_table, use_ext_law, set_ext_law, apply_ext_law, get_model, nebular_continuum, get_mask
+from .mcmc import set_chain_size, set_walker_size, set_autocorr_interval, set_pool_size, set_moves, set_initial_positions, set_seed, prior_dict, set_prior_bounds, log_prior, log_likelihood, log_posterior, log_posterior_batch
+from .models import load_ssp_cube, load_ssp_cube_hdf5, convert_fits_to_hdf5, load_ionization_table, use_ext_law, set_ext_law, set_gpu, precompute_ext_law, apply_ext_law, build_model_context, get_model, get_model_batch, nebular_continuum, precompute_nebular, get_mask
+
+
+def __getattr__(name):
+    # The plotting tools pull in matplotlib and corner, so they are only imported when first used
+    if name in ['plot_samples', 'print_stats']:
+        from . import vis
+        return getattr(vis, name)
+    
+    raise AttributeError("module 'sesamme' has no attribute '"+name+"'")
@@ -1,11 +1,23 @@
-### File and unit handling tools
-from astropy.table import Table
+### File handling and warnings
 import warnings
+import sys
+
+### Parallel processing
+import os
+import multiprocessing
+from multiprocessing import shared_memory
+import functools
 
 ### Manipulating arrays
 import numpy as np
 import emcee
 
+### Optional JIT compilation of the likelihood
+try:
+    from numba import njit
+    _HAS_NUMBA = True
+except ImportError:
+    _HAS_NUMBA = False
 
 
 
@@ -19,9 +31,22 @@ import sesamme.models as models
 nwalkers, ndim = 128, 4
 nsteps = 10000
 
+# Set how often (in steps) to check the chains for convergence, ending the run early once they 
+# have converged (0 = always run the full chain)
+autocorr_interval = 200
 
-# Set the initial positions of the walker ensemble
-initial_pos = [7., -2.0, 0.2, -2.0] + ([0.1, 0.1, 0.1, 0.1] * np.random.randn(nwalkers, ndim))
+# Set the number of processes used to evaluate the walkers (1 = serial)
+nprocs = 1
+
+# Set the proposal moves used by the sampler. Differential-evolution moves mix quickly 
+# through the strongly correlated age-metallicity-extinction posteriors typical of SSP fits
+moves = [(emcee.moves.DEMove(), 0.8), (emcee.moves.DESnookerMove(), 0.2)]
+
+# Set the seed for the random numbers used to place and move the walkers (None = unseeded)
+seed = None
+
+# Set the values around which the walker ensemble is initialized
+initial_centers = [7., -2.0, 0.2, -2.0]
 
 #########################
 
@@ -41,6 +66,8 @@ def set_chain_size(m):
 
 def set_walker_size(m):
     """Updates the size of the walker ensemble. Default value of nwalkers = 128.
+
+    The initial positions are redrawn around their current centers to match the new ensemble size.
     
     Parameters
     ----------
@@ -51,6 +78,58 @@ def set_walker_size(m):
     
     nwalkers = m
     
+    set_initial_positions(initial_centers)
+    
+
+#########################
+
+def set_autocorr_interval(m):
+    """Updates how often the chains are checked for convergence during a run. Default value of autocorr_interval = 200.
+
+    Every ``m`` steps the integrated autocorrelation time tau of each parameter is estimated, and the run ends before reaching the full chain length once the chain is longer than 50 tau and tau has changed by less than 1% since the previous check.
+    
+    Parameters
+    ----------
+    m : int
+        Number of steps between convergence checks; 0 disables early stopping
+    """
+    global autocorr_interval
+    
+    autocorr_interval = m
+    
+
+#########################
+
+def set_pool_size(m):
+    """Updates the number of processes used to evaluate the walker ensemble in parallel. Default value of nprocs = 1 (serial).
+    
+    Parameters
+    ----------
+    m : int or None
+        Number of worker processes; None uses every available core
+    """
+    global nprocs
+    
+    if m is None:
+        m = os.cpu_count()
+    
+    nprocs = m
+    
+
+#########################
+
+def set_moves(m):
+    """Updates the proposal moves used by the emcee sampler. Default is a mix of 80% DEMove and 20% DESnookerMove.
+    
+    Parameters
+    ----------
+    m : emcee.moves.Move or list
+        A single move, or a list of (move, weight) pairs, in any form accepted by emcee.EnsembleSampler
+    """
+    global moves
+    
+    moves = m
+    
 
 #########################
 
@@ -61,15 +140,59 @@ def set_initial_positions(centers):
     
     Parameters
     ----------
-    center : list or np.ndarray
+    centers : list or np.ndarray
         Must contain, in order, a value for log(age), log(Z), E(B-V), and log(ampl).
     """
-    global initial_pos
+    global initial_pos, initial_centers
     
-    age_cen, met_cen, ebv_cen, amp_cen = centers[0], centers[1], centers[2], centers[3]
+    initial_centers = centers
     
-    initial_pos = [age_cen, met_cen, ebv_cen, amp_cen,] + ([0.1, 0.1, 0.1, 0.1] * np.random.randn(nwalkers, ndim))
+    rng = np.random.default_rng(_spawn_seeds()[0])
+    initial_pos = np.asarray(centers, dtype=np.float64)[None, :] + 0.1 * rng.standard_normal((nwalkers, ndim))
+
+#########################
+
+def set_seed(s):
+    """Sets the seed of the random numbers used to initialize and move the walker ensemble, making runs reproducible. Default value of seed = None (unseeded).
 
+    The initial positions are redrawn around their current centers with the new seed.
+    
+    Parameters
+    ----------
+    s : int or None
+        Seed for numpy.random.SeedSequence
+    """
+    global seed
+    
+    seed = s
+    
+    set_initial_positions(initial_centers)
+
+def _spawn_seeds():
+    """
+    Splits the global seed into independent streams: one for the initial positions and one for the sampler.
+
+    Returns
+    -------
+    seeds : list of np.random.SeedSequence
+        Child seed sequences for the initial positions and for the emcee sampler, in that order
+    """
+    return np.random.SeedSequence(seed).spawn(2)
+
+def _seed_sampler(sampler):
+    """
+    Seeds the internal random number generator of an emcee sampler from the global seed, if one is set.
+    
+    Parameters
+    ----------
+    sampler : emcee.EnsembleSampler
+        Sampler to seed
+    """
+    if seed is not None:
+        sampler.random_state = np.random.RandomState(np.random.MT19937(_spawn_seeds()[1])).get_state()
+
+# Set the initial positions of the walker ensemble
+set_initial_positions(initial_centers)
 
 #########################
 
@@ -78,6 +201,12 @@ prior_dict = dict.fromkeys(['age','met', 'ebv', 'amp'])
 prior_lowbounds = [6.0, -3.0, 0.01, -20.]
 prior_highbounds = [7.5, -1.5, 1.0, 1.0]
 
+# Lower and upper prior boundaries as plain floats, cached by set_prior_bounds() for use in log_prior()
+_age_lo, _age_hi = None, None
+_met_lo, _met_hi = None, None
+_ebv_lo, _ebv_hi = None, None
+_amp_lo, _amp_hi = None, None
+
 def set_prior_bounds(prior_dict, prior_lowbounds, prior_highbounds):
     """Set boundaries on the priors for an MCMC run.
  
@@ -94,7 +223,12 @@ def set_prior_bounds(prior_dict, prior_lowbounds, prior_highbounds):
     ------
     ValueError
         If boundaries are not increasing from the first column (expected lower) to the second (higher).
+
+    Notes
+    -----
+    The boundaries are validated and cached here, once, rather than on every evaluation of log_prior(). Always change them through this function instead of editing ``prior_dict`` directly.
     """
+    global _age_lo, _age_hi, _met_lo, _met_hi, _ebv_lo, _ebv_hi, _amp_lo, _amp_hi
 
     prior_dict['age'] = [prior_lowbounds[0], prior_highbounds[0]]
     prior_dict['met'] = [prior_lowbounds[1], prior_highbounds[1]]
@@ -102,6 +236,11 @@ def set_prior_bounds(prior_dict, prior_lowbounds, prior_highbounds):
     prior_dict['amp'] = [prior_lowbounds[3], prior_highbounds[3]]
     
     _check_prior_bounds(prior_dict)
+    
+    _age_lo, _age_hi = float(prior_dict['age'][0]), float(prior_dict['age'][1])
+    _met_lo, _met_hi = float(prior_dict['met'][0]), float(prior_dict['met'][1])
+    _ebv_lo, _ebv_hi = float(prior_dict['ebv'][0]), float(prior_dict['ebv'][1])
+    _amp_lo, _amp_hi = float(prior_dict['amp'][0]), float(prior_dict['amp'][1])
 
 #########################
 
@@ -139,7 +278,7 @@ def _check_prior_bounds(prior_dict):
 
 def log_prior(theta):
     """
-    Calculate a flat prior probability within the bounds prescribed below.
+    Calculate a flat prior probability within the bounds set by set_prior_bounds().
     
     Parameters
     ----------
@@ -153,24 +292,217 @@ def log_prior(theta):
         0 if parameters in ``theta`` are within allowed ranges, or -inf otherwise
     """
     
-    # Ensure the priors make sense...
-    _check_prior_bounds(prior_dict)
-    
-    # ...Then use them to set the flat prior probability
-    
     logt, logZ, ebv, ampl = theta
     
-    if prior_dict['age'][0] <= logt <= prior_dict['age'][1] and \
-    prior_dict['met'][0] <= logZ <= prior_dict['met'][1] and \
-    prior_dict['ebv'][0] < ebv < prior_dict['ebv'][1] and \
-    prior_dict['amp'][0] < ampl < prior_dict['amp'][1] :
+    if _age_lo <= logt <= _age_hi and _met_lo <= logZ <= _met_hi and \
+    _ebv_lo < ebv < _ebv_hi and _amp_lo < ampl < _amp_hi:
         return 0.0
     else:
         return -np.inf
 
 #########################
 
-def log_likelihood(y, yerr, y_model, mask):
+def _prepare_data(y, yerr, mask, dtype=np.float64):
+    """
+    Restricts the data to the wavelength bins used in the fit, once per run, so that the likelihood never has to index with the mask.
+    
+    Parameters
+    ----------
+    y : array-like
+        Flux array
+    yerr : array-like
+        Flux uncertainty array
+    mask : array-like
+        Marks which wavelength bins to ignore during fitting; either a boolean mask or the integer indices of the bins to keep
+    dtype : data-type
+        Floating-point type of the returned flux array; optional. The inverse variances and the normalization term are always kept in double precision, since 1 / yerr**2 overflows single precision for fluxes in cgs units.
+
+    Returns
+    -------
+    y_sel : np.ndarray
+        Flux array over the unmasked bins
+    inv_var_sel : np.ndarray
+        Inverse flux variances (1 / yerr**2) over the unmasked bins
+    idx : np.ndarray
+        Integer indices of the unmasked bins
+    log_err_norm : float
+        Normalization term of the likelihood, from _log_err_norm()
+    """
+    idx = np.asarray(mask)
+    if idx.dtype == bool:
+        idx = np.flatnonzero(idx)
+    
+    y_sel = np.ascontiguousarray(np.asarray(y, dtype=np.float64)[idx], dtype=dtype)
+    inv_var_sel = 1.0 / np.asarray(yerr, dtype=np.float64)[idx]**2
+    
+    return y_sel, inv_var_sel, idx, _log_err_norm(yerr, idx)
+
+#########################
+
+def _log_prior_batch(thetas):
+    """
+    Calculate the flat prior probability for a whole ensemble of walkers at once; the batched equivalent of log_prior().
+    
+    Parameters
+    ----------
+    thetas : np.ndarray
+        Array of shape (nwalkers, 4); each row contains, in order, a log(age) logt, a log(metallicity) logZ, an E(B-V) value ebv, and an amplitude ampl.
+
+    Returns
+    -------
+    lp : np.ndarray
+        0 for each walker whose parameters are within allowed ranges, or -inf otherwise
+    """
+    
+    logt, logZ, ebv, ampl = np.asarray(thetas).T
+    
+    in_bounds = (_age_lo <= logt) & (logt <= _age_hi) & (_met_lo <= logZ) & (logZ <= _met_hi) & \
+                (_ebv_lo < ebv) & (ebv < _ebv_hi) & (_amp_lo < ampl) & (ampl < _amp_hi)
+    
+    return np.where(in_bounds, 0.0, -np.inf)
+
+#########################
+
+def _masked_chi2(y_sel, inv_var_sel, y_model, idx):
+    """
+    Sum the squared, error-weighted residuals of every model over the unmasked wavelength bins in a single pass.
+    
+    Written as explicit loops so that it can be compiled with Numba; there are no temporary arrays.
+    
+    Parameters
+    ----------
+    y_sel : np.ndarray
+        Flux array over the unmasked bins
+    inv_var_sel : np.ndarray
+        Inverse flux variances (1 / yerr**2) over the unmasked bins
+    y_model : np.ndarray
+        2D array of model fluxes, one row per walker
+    idx : np.ndarray
+        Integer indices of the unmasked bins
+
+    Returns
+    -------
+    chi2 : np.ndarray
+        Sum of squared residuals for each row of ``y_model``, always accumulated in double precision
+    """
+    chi2 = np.empty(y_model.shape[0])
+    
+    for j in range(y_model.shape[0]):
+        s = 0.
+        for k in range(idx.size):
+            d = y_sel[k] - y_model[j, idx[k]]
+            # Weighting one factor of the residual first keeps the product in double precision, so it cannot underflow
+            s += d * (d * inv_var_sel[k])
+        chi2[j] = s
+    
+    return chi2
+
+if _HAS_NUMBA:
+    _masked_chi2 = njit(fastmath=True, cache=True)(_masked_chi2)
+
+#########################
+
+def _log_err_norm(yerr, mask):
+    """
+    Computes the normalization term of the likelihood, which depends only on the data and so can be evaluated once per run.
+    
+    Parameters
+    ----------
+    yerr : array-like
+        Flux uncertainty array
+    mask : array-like
+        Marks which wavelength bins to ignore during fitting; either a boolean mask or the integer indices of the bins to keep
+
+    Returns
+    -------
+    log_err_norm : float
+        Natural log of 2 * pi * sum(yerr**2) over the unmasked bins
+    """
+    masked_err = np.asarray(yerr, dtype=np.float64)[mask]
+    
+    return np.log(2 * np.pi * np.einsum('i,i->', masked_err, masked_err))
+
+#########################
+
+# Scratch space for the residuals, reused between likelihood evaluations
+_resid_buf = np.empty((0, 0))
+
+def _get_resid_buffer(nrows, ncols, dtype=np.float64):
+    """
+    Returns an (nrows, ncols) view of the scratch buffer, growing the buffer only when it is too small.
+    
+    Parameters
+    ----------
+    nrows : int
+        Number of models
+    ncols : int
+        Number of unmasked wavelength bins
+    dtype : data-type
+        Floating-point type of the buffer; optional
+
+    Returns
+    -------
+    buf : np.ndarray
+        Uninitialized array of shape (nrows, ncols)
+    """
+    global _resid_buf
+    
+    if _resid_buf.shape[0] < nrows or _resid_buf.shape[1] != ncols or _resid_buf.dtype != dtype:
+        _resid_buf = np.empty((nrows, ncols), dtype=dtype)
+    
+    return _resid_buf[:nrows]
+
+#########################
+
+def _log_likelihood(y_sel, inv_var_sel, y_model, idx, log_err_norm):
+    """
+    Evaluate the likelihood function using data that have already been restricted to the unmasked bins by _prepare_data(). This is the form used during an MCMC run.
+
+    The residuals are computed in the precision of ``y_sel``, but the sum of squares is always accumulated in double precision.
+    
+    Parameters
+    ----------
+    y_sel : np.ndarray
+        Flux array over the unmasked bins
+    inv_var_sel : np.ndarray
+        Inverse flux variances (1 / yerr**2) over the unmasked bins
+    y_model : np.ndarray
+        Model flux array, or a 2D array of shape (nwalkers, len(y)) with one model per row
+    idx : np.ndarray
+        Integer indices of the unmasked bins
+    log_err_norm : float
+        Normalization term of the likelihood, from _log_err_norm()
+
+    Returns
+    -------
+    resid : float or np.ndarray
+        -1 * log(likelihood), where log(n) means the natural logarithm
+    """
+    # No copy is made during a run, where the models are already built in the precision of the data
+    y_model = np.asarray(y_model, dtype=y_sel.dtype)
+    models_2d = np.atleast_2d(y_model)
+    
+    if _HAS_NUMBA:
+        chi2 = _masked_chi2(y_sel, inv_var_sel, models_2d, idx)
+    
+    else:
+        # Gather and subtract in place, so no temporaries are allocated
+        masked_spec = np.take(models_2d, idx, axis=1, out=_get_resid_buffer(len(models_2d), len(idx), y_sel.dtype))
+        np.subtract(y_sel, masked_spec, out=masked_spec)
+        # The weighted sum of squares is a matrix-vector product, which BLAS handles in double precision;
+        # single-precision residuals go through einsum instead, which squares and sums them in double precision 
+        # (squaring them in single precision would underflow for fluxes in cgs units)
+        if masked_spec.dtype == np.float64:
+            np.multiply(masked_spec, masked_spec, out=masked_spec)
+            chi2 = np.dot(masked_spec, inv_var_sel)
+        else:
+            chi2 = np.einsum('ij,ij,j->i', masked_spec, masked_spec, inv_var_sel, dtype=np.float64)
+    
+    resid = -0.5 * (chi2 + log_err_norm)
+    
+    return resid if y_model.ndim > 1 else resid[0]
+
+def log_likelihood(y, yerr, y_model, mask, log_err_norm=None):
     """
     Evaluate the likelihood function by comparing the data and chosen model at every wavelength bin. 
     
@@ -181,25 +513,25 @@ def log_likelihood(y, yerr, y_model, mask):
     yerr : array-like
         Flux uncertainty array
     y_model : array-like
-        Model flux array
+        Model flux array. May also be a 2D array of shape (nwalkers, len(y)), in which case one likelihood is returned per row.
     mask : array-like
-        Marks which wavelength bins to ignore during fitting
-    theta : list or np.ndarray
-        Array containing, in order, a log(age) logt, a log(metallicity) logZ, an E(B-V) value ebv, and an amplitude ampl.
+        Marks which wavelength bins to ignore during fitting; either a boolean mask or the integer indices of the bins to keep
+    log_err_norm : float
+        Precomputed normalization term from _log_err_norm(); optional. Computed on the fly if not given.
     
 
     Returns
     -------
-    resid : float
+    resid : float or np.ndarray
         -1 * log(likelihood), where log(n) means the natural logarithm
     """  
     
-    masked_spec = np.array( (y[mask] - y_model[mask]) / yerr[mask] )
-    masked_err = np.array( np.sqrt(2) * np.sqrt(np.pi) * yerr[mask])
+    y_sel, inv_var_sel, idx, norm = _prepare_data(y, yerr, mask)
     
-    resid = -0.5 * (np.dot(masked_spec, masked_spec) + np.log(np.dot(masked_err, masked_err)))
-
-    return resid
+    if log_err_norm is None:
+        log_err_norm = norm
+    
+    return _log_likelihood(y_sel, inv_var_sel, y_model, idx, log_err_norm)
 
 #########################
 
@@ -231,21 +563,385 @@ def log_posterior(theta, x, y, yerr, model_cube, ion_table, mask, add_nebular):
     lp_ll : float
         Sum of ln(prior) and ln(likelihood)
     """
-    y_model = models.get_model(theta, x, model_cube, ion_table, add_nebular)
+    y_sel, inv_var_sel, idx, log_err_norm = _prepare_data(y, yerr, mask)
+    models._select_model_cube(model_cube)
+    
+    return _log_posterior(theta, x, y_sel, inv_var_sel, model_cube, ion_table, idx, models.get_model_batch_fn(add_nebular), 
+                          log_err_norm, models.build_model_context(x))
+
+def log_posterior_batch(thetas, x, y, yerr, model_cube, ion_table, mask, add_nebular):
+    """
+    Calculates the (log of the) posterior probability for a whole ensemble of walkers at once.
+ 
+    Parameters
+    ----------
+    thetas : np.ndarray
+        Array of shape (nwalkers, 4); each row contains, in order, a log(age) logt, a log(metallicity) logZ, an E(B-V) value ebv, and an amplitude log(ampl).
+    x : array-like
+        Wavelength array
+    y : array-like
+        Flux array
+    yerr : array-like
+        Flux uncertainty array
+    model_cube : FITS
+        Multi-extension FITS cube containing SSP models
+    ion_table : astropy Table
+        Table object containing ionizing fluxes per SSP
+    mask : array-like
+        Marks which wavelength bins to ignore during fitting
+    add_nebular : Boolean
+        Determines whether to add nebular continuum emission to a model
+
+    Returns
+    -------
+    lp_ll : np.ndarray
+        Sum of ln(prior) and ln(likelihood) for each walker
+    """
+    y_sel, inv_var_sel, idx, log_err_norm = _prepare_data(y, yerr, mask)
+    models._select_model_cube(model_cube)
     
+    return _log_posterior_batch(np.atleast_2d(np.asarray(thetas, dtype=np.float64)), x, y_sel, inv_var_sel, model_cube, ion_table, idx, 
+                                models.get_model_batch_fn(add_nebular), log_err_norm, models.build_model_context(x))
+
+#########################
+
+def _log_posterior(theta, x, y_sel, inv_var_sel, model_cube, ion_table, idx, model_fn, log_err_norm, model_ctx):
+    """
+    Form of log_posterior() used during an MCMC run, with the data already prepared by _prepare_data(), i.e. restricted to the bins used in the fit, and the model function and context chosen up front.
+ 
+    Parameters
+    ----------
+    theta : list or np.ndarray
+        Array containing, in order, a log(age) logt, a log(metallicity) logZ, an E(B-V) value ebv, and an amplitude log(ampl).
+    x : array-like
+        Wavelength array
+    y_sel : np.ndarray
+        Flux array over the unmasked bins
+    inv_var_sel : np.ndarray
+        Inverse flux variances (1 / yerr**2) over the unmasked bins
+    model_cube : FITS
+        Multi-extension FITS cube containing SSP models
+    ion_table : astropy Table
+        Table object containing ionizing fluxes per SSP
+    idx : np.ndarray
+        Integer indices of the unmasked bins
+    model_fn : function
+        Batched model function, from models.get_model_batch_fn()
+    log_err_norm : float
+        Normalization term of the likelihood
+    model_ctx : dict
+        Precomputed wavelength-dependent model quantities, from models.build_model_context()
+
+    Returns
+    -------
+    lp_ll : float
+        Sum of ln(prior) and ln(likelihood)
+    """
+    # Check the prior first, so that no model is built for proposals outside the prior volume
     lp = log_prior(theta)
     if not np.isfinite(lp):
         return -np.inf
     
-    ll = log_likelihood(y, yerr, y_model, mask)
+    y_model = model_fn(np.atleast_2d(theta), x, model_cube, ion_table, model_ctx)[0]
+    
+    ll = _log_likelihood(y_sel, inv_var_sel, y_model, idx, log_err_norm)
     
     return lp + ll
 
 #########################
 
-def run_sesamme(filename, runname, x, y, yerr, model_cube, ion_table, mask, add_nebular=True):
+def _log_posterior_batch(thetas, x, y_sel, inv_var_sel, model_cube, ion_table, idx, model_fn, log_err_norm, model_ctx):
     """
-    Initiate an MCMC procedure and write the results to a file/extension name.
+    Form of log_posterior_batch() used during an MCMC run, with the data and model prepared as for _log_posterior().
+
+    This is the form of the posterior that emcee expects when the sampler is created with ``vectorize=True``. The prior, the models, and the residuals of the full ensemble are each evaluated in a single call.
+ 
+    Parameters
+    ----------
+    thetas : np.ndarray
+        Array of shape (nwalkers, 4); each row contains, in order, a log(age) logt, a log(metallicity) logZ, an E(B-V) value ebv, and an amplitude log(ampl).
+    x : array-like
+        Wavelength array
+    y_sel : np.ndarray
+        Flux array over the unmasked bins
+    inv_var_sel : np.ndarray
+        Inverse flux variances (1 / yerr**2) over the unmasked bins
+    model_cube : FITS
+        Multi-extension FITS cube containing SSP models
+    ion_table : astropy Table
+        Table object containing ionizing fluxes per SSP
+    idx : np.ndarray
+        Integer indices of the unmasked bins
+    model_fn : function
+        Batched model function, from models.get_model_batch_fn()
+    log_err_norm : float
+        Normalization term of the likelihood
+    model_ctx : dict
+        Precomputed wavelength-dependent model quantities, from models.build_model_context()
+
+    Returns
+    -------
+    lp_ll : np.ndarray
+        Sum of ln(prior) and ln(likelihood) for each walker
+    """
+    lp = _log_prior_batch(thetas)
+    good = np.isfinite(lp)
+    
+    lp_ll = np.full(len(thetas), -np.inf)
+    if not np.any(good):
+        return lp_ll
+    
+    # Only build models for walkers that landed inside the prior volume
+    y_models = model_fn(thetas[good], x, model_cube, ion_table, model_ctx)
+    
+    lp_ll[good] = lp[good] + _log_likelihood(y_sel, inv_var_sel, y_models, idx, log_err_norm)
+    
+    return lp_ll
+
+#########################
+
+# _log_posterior with its constant arguments bound, set once per worker process by _init_worker()
+_worker_posterior = None
+
+# The shared memory block holding the SSP spectra, kept open for the lifetime of a worker process
+_worker_shm = None
+
+def _init_worker(posterior_kwargs, prior_bounds, grid_state, cube_spec):
+    """
+    Sets up a worker process: restores the prior boundaries and model grid, and binds the (large, constant) arguments of _log_posterior so they are only sent once per worker rather than once per walker evaluation.
+
+    Worker processes do not necessarily inherit the module state of the parent (e.g. under the 'spawn' start method), so everything _log_posterior relies on is set up here explicitly. The SSP spectra are not copied at all: every worker reads them from the same block of shared memory.
+    
+    Parameters
+    ----------
+    posterior_kwargs : dict
+        Keyword arguments of _log_posterior other than theta
+    prior_bounds : tuple
+        Lower and upper prior boundaries, each in order of log(age), log(Z), E(B-V), and log(ampl)
+    grid_state : dict
+        Model grid of the parent process, from models._get_grid_state()
+    cube_spec : tuple
+        Name of the shared memory block holding the SSP spectra, and their shape and dtype
+    """
+    global _worker_posterior, _worker_shm
+    global _age_lo, _age_hi, _met_lo, _met_hi, _ebv_lo, _ebv_hi, _amp_lo, _amp_hi
+    
+    (_age_lo, _met_lo, _ebv_lo, _amp_lo), (_age_hi, _met_hi, _ebv_hi, _amp_hi) = prior_bounds
+    
+    shm_name, shape, dtype = cube_spec
+    _worker_shm = shared_memory.SharedMemory(name = shm_name)
+    models._set_grid_state(grid_state, np.ndarray(shape, dtype = dtype, buffer = _worker_shm.buf))
+    
+    _worker_posterior = functools.partial(_log_posterior, **posterior_kwargs)
+    
+    # Each worker gets its own residual buffer
+    _get_resid_buffer(1, len(posterior_kwargs['y_sel']), posterior_kwargs['y_sel'].dtype)
+
+def _log_posterior_worker(theta):
+    """
+    Evaluates _log_posterior inside a worker process using the arguments stored by _init_worker().
+    
+    Parameters
+    ----------
+    theta : list or np.ndarray
+        Array containing, in order, a log(age) logt, a log(metallicity) logZ, an E(B-V) value ebv, and an amplitude log(ampl).
+
+    Returns
+    -------
+    lp_ll : float
+        Sum of ln(prior) and ln(likelihood)
+    """
+    return _worker_posterior(theta)
+
+#########################
+
+class _BufferedHDFBackend(emcee.backends.HDFBackend):
+    """
+    An emcee HDF5 backend that keeps recent steps in memory and writes them to disk in blocks.
+
+    The stock HDFBackend opens the file and writes one step at a time. Here, ``flush_interval`` steps are collected before a single write, into chunked and (by default) LZF-compressed datasets whose chunks match the size of a block. The resulting file is an ordinary emcee HDF5 file and can be read back with emcee.backends.HDFBackend.
+
+    Steps still held in memory are written out by flush(), which is called automatically before anything is read back from the backend. Steps that have not been flushed are lost if the process dies.
+
+    The shape of the ensemble, whether blobs are stored, and the number of steps on disk are cached when the datasets are created or written, so that saving a step and querying the iteration never open the file.
+
+    Parameters
+    ----------
+    filename : str
+        Name of \*.H5 file to write results to
+    name : str
+        Extension/run name within the file
+    flush_interval : int
+        Number of steps to hold in memory between writes; also sets the chunk length of the datasets
+    compression : str
+        HDF5 compression filter for the datasets
+    kwargs : 
+        Passed on to emcee.backends.HDFBackend
+    """
+
+    def __init__(self, filename, name="mcmc", flush_interval=1024, compression="lzf", **kwargs):
+        super().__init__(filename, name=name, compression=compression, **kwargs)
+        self.flush_interval = flush_interval
+        self._meta = None
+        self._clear_buffer()
+
+    def _clear_buffer(self):
+        self._coords, self._log_prob, self._blobs = [], [], []
+        self._accepted = 0
+        self._random_state = None
+
+    def reset(self, nwalkers, ndim):
+        """Clears the buffer and creates empty, chunked datasets for a new run."""
+        self._clear_buffer()
+        
+        with self.open("a") as f:
+            if self.name in f:
+                del f[self.name]
+
+            g = f.create_group(self.name)
+            g.attrs["version"] = emcee.__version__
+            g.attrs["nwalkers"] = nwalkers
+            g.attrs["ndim"] = ndim
+            g.attrs["has_blobs"] = False
+            g.attrs["iteration"] = 0
+            g.create_dataset("accepted", data=np.zeros(nwalkers))
+            g.create_dataset("chain", (0, nwalkers, ndim), maxshape=(None, nwalkers, ndim), dtype=self.dtype, 
+                             chunks=(self.flush_interval, nwalkers, ndim), 
+                             compression=self.compression, compression_opts=self.compression_opts)
+            g.create_dataset("log_prob", (0, nwalkers), maxshape=(None, nwalkers), dtype=self.dtype, 
+                             chunks=(self.flush_interval, nwalkers), 
+                             compression=self.compression, compression_opts=self.compression_opts)
+        
+        self._meta = {'nwalkers' : nwalkers, 'ndim' : ndim, 'has_blobs' : False, 'iteration' : 0}
+
+    def _read_meta(self):
+        """Returns the cached attributes of the run, reading them from the file the first time."""
+        if self._meta is None:
+            with self.open() as f:
+                attrs = f[self.name].attrs
+                self._meta = {k : attrs[k] for k in ('nwalkers', 'ndim', 'has_blobs', 'iteration')}
+        
+        return self._meta
+
+    @property
+    def shape(self):
+        meta = self._read_meta()
+        return meta['nwalkers'], meta['ndim']
+
+    def has_blobs(self):
+        return self._read_meta()['has_blobs']
+
+    def grow(self, ngrow, blobs):
+        """Resizes the datasets as the stock backend does, and notes whether blobs are now stored."""
+        # The stock backend sizes the datasets from the steps on disk, so any buffered steps have to be written first
+        self.flush()
+        super().grow(ngrow, blobs)
+        if blobs is not None:
+            self._read_meta()['has_blobs'] = True
+
+    def save_step(self, state, accepted):
+        """Holds a step in memory, writing the buffer to disk once it is full."""
+        self._check(state, accepted)
+        
+        self._coords.append(np.array(state.coords))
+        self._log_prob.append(np.array(state.log_prob))
+        if state.blobs is not None:
+            self._blobs.append(np.array(state.blobs))
+        self._accepted = self._accepted + accepted
+        self._random_state = state.random_state
+        
+        if len(self._coords) >= self.flush_interval:
+            self.flush()
+
+    def flush(self):
+        """Writes every step held in memory to disk."""
+        nbuf = len(self._coords)
+        if nbuf == 0:
+            return
+        
+        iteration = self._read_meta()['iteration']
+        
+        with self.open("a") as f:
+            g = f[self.name]
+
+            g["chain"][iteration:iteration + nbuf] = np.stack(self._coords)
+            g["log_prob"][iteration:iteration + nbuf] = np.stack(self._log_prob)
+            if len(self._blobs):
+                g["blobs"][iteration:iteration + nbuf] = np.stack(self._blobs)
+            g["accepted"][:] += self._accepted
+
+            for i, v in enumerate(self._random_state):
+                g.attrs["random_state_{0}".format(i)] = v
+
+            g.attrs["iteration"] = iteration + nbuf
+        
+        self._meta['iteration'] = iteration + nbuf
+        self._clear_buffer()
+
+    @property
+    def iteration(self):
+        return self._read_meta()['iteration'] + len(self._coords)
+
+    @property
+    def accepted(self):
+        self.flush()
+        return super().accepted
+
+    @property
+    def random_state(self):
+        self.flush()
+        return super().random_state
+
+    def get_value(self, name, flat=False, thin=1, discard=0):
+        self.flush()
+        return super().get_value(name, flat=flat, thin=thin, discard=discard)
+
+#########################
+
+def _sample(sampler, backend, progress):
+    """
+    Advances the sampler from the initial positions for up to nsteps steps, stopping early once the chains have converged (see set_autocorr_interval()).
+    
+    Parameters
+    ----------
+    sampler : emcee.EnsembleSampler
+        Sampler to advance
+    backend : _BufferedHDFBackend
+        Backend of the sampler; flushed to disk when sampling ends, however it ends
+    progress : Boolean
+        Determines whether to display a progress bar
+    """
+    old_tau = np.inf
+    
+    try:
+        # Steps are counted here rather than through sampler.iteration, which asks the backend
+        for step, _ in enumerate(sampler.sample(initial_pos, iterations=nsteps, progress=progress), start=1):
+            if not autocorr_interval or step % autocorr_interval:
+                continue
+            
+            try:
+                tau = sampler.get_autocorr_time(tol=0)
+            except emcee.autocorr.AutocorrError:
+                continue
+            
+            if np.all(tau * 50 < step) and np.all(np.abs(old_tau - tau) / tau < 0.01):
+                break
+            
+            old_tau = tau
+    
+    finally:
+        backend.flush()
+
+#########################
+
+# Floating-point types corresponding to the precision options of run_sesamme()
+_precision_dtypes = {'fp64' : np.float64, 'fp32' : np.float32}
+
+def _run_sesamme_core(filename, runname, x, y, yerr, model_cube, ion_table, mask, add_nebular=True, precision='fp64', progress=False):
+    """
+    Run the MCMC procedure and write the results to a file/extension name, without any interaction with the user.
+
+    This is the non-interactive part of run_sesamme(), suitable for batch jobs and parameter sweeps.
     
 
     Parameters
@@ -268,35 +964,152 @@ def run_sesamme(filename, runname, x, y, yerr, model_cube, ion_table, mask, add_
         Marks which wavelength bins to ignore during fitting
     add_nebular : Boolean
         Determines whether to add nebular continuum emission to a model
+    precision : str
+        Floating-point precision of the data-model comparison, 'fp64' (default) or 'fp32'. Single precision halves the memory traffic of the likelihood; chi-squared is still accumulated in double precision.
+    progress : Boolean
+        Determines whether to display a progress bar; optional
+
+    Returns
+    -------
+    sampler : emcee.EnsembleSampler
+        Sampler object after the run
+
+    Raises
+    ------
+    ValueError
+        String precision is not in the list of allowable values, or models are built on the GPU (see models.set_gpu()) while the walkers are spread over a pool of processes
     """
 
-    global nwalkers, nsteps, ndim
+    global nwalkers, nsteps, ndim, nprocs, moves
     global initial_pos
+    
+    if precision not in _precision_dtypes:
+        raise ValueError("'"+str(precision)+"'" +" is not a valid choice of precision. Accepted values are 'fp64' and 'fp32'.")
+    
+    # CUDA cannot be used in a process forked from one that has already initialized it, and the GPU 
+    # builds the models of every walker in one kernel launch anyway, so there is nothing for a pool to do
+    if nprocs > 1 and models.use_gpu:
+        raise ValueError("Building models on the GPU cannot be combined with a pool of processes.\n \
+Either call set_pool_size(1) or models.set_gpu(False).")
 
-    # Confirm with the user that they want to proceed with the current settings
-    print("Active extinction law = "+models.use_ext_law + "; Ensemble size = "+str(nwalkers) + 
-         "; Chain length = "+str(nsteps))
-    yesno = input("Begin a SESAMME run with these parameters? (y/n)  ")
+    # Set up new HDF backend and run the EnsembleSampler in the usual emcee fashion. 
+    # Steps are written to the file in large blocks rather than one at a time. Blocks are written at the same 
+    # cadence as the convergence checks, which need the chain on disk anyway, so each chunk is written only once.
+    backend = _BufferedHDFBackend(filename, name = runname, flush_interval = autocorr_interval or 1024)
+    backend.reset(nwalkers, ndim)
+    
+    # Apply the mask to the data, and compute the likelihood normalization, once rather than on every evaluation
+    y_sel, inv_var_sel, idx, log_err_norm = _prepare_data(y, yerr, mask, _precision_dtypes[precision])
+    
+    # Likewise for the parts of the model that depend only on the wavelength grid, once the grid of this
+    # run's model cube is installed (it is also the grid that is sent to pool workers).
+    # The models are built directly in the precision of the run, so they never need to be converted
+    models._select_model_cube(model_cube)
+    model_ctx = models.build_model_context(x, _precision_dtypes[precision])
     
-    if yesno in ['n', 'no', 'N', 'NO']:
-        print("Run canceled.")
-        return
+    # The arguments of the posterior are fixed for the whole run, so bind them once up front 
+    # instead of having emcee unpack them on every call. This includes the model function, 
+    # which is chosen here, once, according to add_nebular.
+    posterior_kwargs = dict(x = x, y_sel = y_sel, inv_var_sel = inv_var_sel, model_cube = model_cube, ion_table = ion_table, 
+                            idx = idx, model_fn = models.get_model_batch_fn(add_nebular), log_err_norm = log_err_norm, 
+                            model_ctx = model_ctx)
     
-    elif yesno in ['y', 'Y', 'yes', 'YES']:
-        # Set up new HDF backend and run the EnsembleSampler in the usual emcee fashion
-        backend = emcee.backends.HDFBackend(filename, name = runname)
-        backend.reset(nwalkers, ndim)
+    # Allocate the residual buffer up front, large enough for the whole ensemble
+    _get_resid_buffer(nwalkers, len(idx), y_sel.dtype)
+    
+    if nprocs > 1:
+        # Walkers are independent, so farm them out to a pool of processes. 
+        # The constant arguments are shipped to each worker once, through the initializer. 
+        # The SSP spectra, by far the largest of them, are instead placed in shared memory that every worker reads from, 
+        # so the model cube (which may not even be picklable) never has to be sent.
+        shm = shared_memory.SharedMemory(create = True, size = models._ssp_cube.nbytes)
+        shared_cube = np.ndarray(models._ssp_cube.shape, dtype = models._ssp_cube.dtype, buffer = shm.buf)
+        shared_cube[...] = models._ssp_cube
+        cube_spec = (shm.name, shared_cube.shape, shared_cube.dtype.str)
+        
+        worker_kwargs = dict(posterior_kwargs, model_cube = None)
+        prior_bounds = ((_age_lo, _met_lo, _ebv_lo, _amp_lo), (_age_hi, _met_hi, _ebv_hi, _amp_hi))
+        
+        try:
+            with multiprocessing.Pool(processes=nprocs, initializer=_init_worker, 
+                                      initargs=(worker_kwargs, prior_bounds, models._get_grid_state(), cube_spec)) as pool:
+                sampler = emcee.EnsembleSampler(
+                    nwalkers, ndim, _log_posterior_worker, backend = backend, moves = moves, pool = pool
+                )
+                _seed_sampler(sampler)
+                
+                _sample(sampler, backend, progress)
         
+        finally:
+            # The view has to go before the block can be closed
+            del shared_cube
+            shm.close()
+            shm.unlink()
+    
+    else:
         sampler = emcee.EnsembleSampler(
-            nwalkers, ndim, log_posterior, backend = backend, args=(x, y, yerr, 
-                                                  model_cube, ion_table, mask, add_nebular)
+            nwalkers, ndim, functools.partial(_log_posterior_batch, **posterior_kwargs), backend = backend, moves = moves, 
+            vectorize = True
         )
+        _seed_sampler(sampler)
         
-        sampler.run_mcmc(initial_pos, nsteps, progress=True);
+        _sample(sampler, backend, progress)
+    
+    return sampler
+
+#########################
+
+def run_sesamme(filename, runname, x, y, yerr, model_cube, ion_table, mask, add_nebular=True, precision='fp64', confirm=True):
+    """
+    Initiate an MCMC procedure and write the results to a file/extension name.
+    
+
+    Parameters
+    ----------
+    filename : str
+        Name of \*.H5 file to write results to
+    runname : str
+        Extension/run name within the file; can store multiple runs in a single \*.H5 file
+    x : array-like
+        Wavelength array
+    y : array-like
+        Flux array
+    yerr : array-like
+        Flux uncertainty array
+    model_cube : FITS
+        Multi-extension FITS cube containing SSP models
+    ion_table : astropy Table
+        Table object containing ionizing fluxes per SSP
+    mask : array-like
+        Marks which wavelength bins to ignore during fitting
+    add_nebular : Boolean
+        Determines whether to add nebular continuum emission to a model
+    precision : str
+        Floating-point precision of the data-model comparison, 'fp64' (default) or 'fp32'. Single precision halves the memory traffic of the likelihood; chi-squared is still accumulated in double precision.
+    confirm : Boolean
+        Determines whether to ask for confirmation before starting the run; optional. The prompt is only shown when standard input is a terminal, so scripted and batch runs never block.
+    """
+
+    # Confirm with the user that they want to proceed with the current settings
+    print("Active extinction law = "+models.use_ext_law + "; Ensemble size = "+str(nwalkers) + 
+         "; Chain length = "+str(nsteps) + "; Processes = "+str(nprocs))
+    
+    if confirm and sys.stdin.isatty():
+        yesno = input("Begin a SESAMME run with these parameters? (y/n)  ")
         
-        print(
-            "Mean acceptance fraction: {0:.3f}".format(np.mean(sampler.acceptance_fraction))
-        )
+        if yesno in ['n', 'no', 'N', 'NO']:
+            print("Run canceled.")
+            return
         
-    else:
-        print("\n Unknown response. Please use y / yes / Y / YES to begin or n / no / N / NO to change your mind.")
+        elif yesno not in ['y', 'Y', 'yes', 'YES']:
+            print("\n Unknown response. Please use y / yes / Y / YES to begin or n / no / N / NO to change your mind.")
+            return
+    
+    sampler = _run_sesamme_core(filename, runname, x, y, yerr, model_cube, ion_table, mask, add_nebular, precision, progress=True)
+    
+    if sampler.iteration < nsteps:
+        print("Chains converged; run ended after "+str(sampler.iteration)+" steps.")
+    
+    print(
+        "Mean acceptance fraction: {0:.3f}".format(np.mean(sampler.acceptance_fraction))
+    )
@@ -1,11 +1,29 @@
 ### File and unit handling tools
 from astropy.io import fits
+import h5py
+try:
+    import fitsio
+    _HAS_FITSIO = True
+except ImportError:
+    _HAS_FITSIO = False
 from astropy.table import Table
 import astropy.units as u
 
 ### Manipulating arrays
 import numpy as np
-from scipy import interpolate
+import bisect
+import weakref
+
+### Optional JIT compilation of the model construction
+try:
+    from numba import njit
+    _HAS_NUMBA = True
+except ImportError:
+    _HAS_NUMBA = False
+
+### Optional GPU acceleration of the model construction
+# CuPy is slow to import and initializes the CUDA runtime, so it is only imported by set_gpu()
+cp = None
 
 ### Dust models
 import extinction, dust_extinction
@@ -13,6 +31,7 @@ from dust_extinction.parameter_averages import G23
 from dust_extinction.averages import G03_LMCAvg, G03_SMCBar
 
 use_ext_law = 'CCM'
+use_gpu = False
 
 
 def load_ssp_cube(file_name):
@@ -20,6 +39,8 @@ def load_ssp_cube(file_name):
     Loads in the SSP model cube.
     Implicitly alters the model grid to be sampled with emcee through _ingest_model_grid().
 
+    Both multi-extension FITS cubes and HDF5 cubes (see convert_fits_to_hdf5()) are accepted; HDF5 files are handed over to load_ssp_cube_hdf5().
+
     Parameters
     ----------
     file_name : str
@@ -27,11 +48,37 @@ def load_ssp_cube(file_name):
 
     Returns
     -------
-    model_cube : FITS
-        Multi-extension FITS cube containing SSP models
+    model_cube : FITS or h5py File
+        Multi-extension FITS cube or HDF5 file containing SSP models
+    """
+
+    if h5py.is_hdf5(file_name):
+        return load_ssp_cube_hdf5(file_name)
+
+    # The spectra are copied out of the cube when it is ingested, so there is no need to read every extension up front
+    model_cube = fits.open(file_name, memmap=True, lazy_load_hdus=True)
+    
+    _ingest_model_grid(model_cube)
+    
+    return model_cube
+
+def load_ssp_cube_hdf5(file_name):
     """
+    Loads in an SSP model cube stored in HDF5 format, as written by convert_fits_to_hdf5().
+    Implicitly alters the model grid to be sampled with emcee through _ingest_model_grid().
 
-    model_cube = fits.open(file_name)
+    Parameters
+    ----------
+    file_name : str
+        File path and name
+
+    Returns
+    -------
+    model_cube : h5py File
+        HDF5 file containing SSP models, opened read-only
+    """
+
+    model_cube = h5py.File(file_name, 'r')
     
     _ingest_model_grid(model_cube)
     
@@ -58,15 +105,40 @@ def load_ionization_table(file_name):
 
 #########################
 
+def convert_fits_to_hdf5(fits_file, h5_file):
+    """
+    Converts a multi-extension FITS model cube to an HDF5 file, which is considerably faster to load.
+
+    The HDF5 file holds the wavelength array ('wavelength'), the FITS extension names ('metallicity_keys') and column names ('age_keys'), and the SSP spectra ('ssp') as a single array indexed by [metallicity, age, wavelength]. The spectra are chunked along the wavelength axis, so that each chunk is one model spectrum.
 
-def _interpret_metallicity_keys(model_cube):
+    Parameters
+    ----------
+    fits_file : str
+        File path and name of the FITS model cube
+    h5_file : str
+        File path and name of the HDF5 file to be written
+    """
+    
+    with fits.open(fits_file) as model_cube:
+        metal_keys, age_keys, wl, ssp_cube = _read_fits_grid(model_cube)
+    
+    with h5py.File(h5_file, 'w') as f:
+        f.create_dataset('wavelength', data=wl)
+        f.create_dataset('metallicity_keys', data=np.array(metal_keys, dtype='S'))
+        f.create_dataset('age_keys', data=np.array(age_keys, dtype='S'))
+        f.create_dataset('ssp', data=ssp_cube, chunks=(1, 1, len(wl)), compression='lzf')
+
+#########################
+
+
+def _interpret_metallicity_keys(metal_keys):
     """
     Interprets the FITS extension names of the model cube to create the numerical metallicity grid. 
 
     Parameters
     ----------
-    model_cube : FITS
-        Multi-extension FITS cube containing SSP models
+    metal_keys : list
+        List of FITS extension names of the model cube
 
     Returns
     -------
@@ -74,7 +146,6 @@ def _interpret_metallicity_keys(model_cube):
         List of metallicity values describing the model cube
     """
 
-    metal_keys = [model_cube[k].header['EXTNAME'] for k in range(1, len(model_cube))]
     metal_values = []
     
     for key in metal_keys:
@@ -94,31 +165,208 @@ def _interpret_metallicity_keys(model_cube):
 
 #########################
 
+def _read_fits_grid(model_cube):
+    """
+    Reads the metallicity keys, age keys, wavelength array, and SSP spectra (as a [metallicity, age, wavelength] array) out of a FITS model cube.
+    """
+    
+    example_table = model_cube[1].data
+    
+    metal_keys = [model_cube[k].header['EXTNAME'] for k in range(1, len(model_cube))]
+    age_keys = list(example_table.names[1:])
+    wl = np.array(example_table['WL'], dtype=np.float64)
+    
+    ssp_cube = np.empty((len(metal_keys), len(age_keys), len(wl)), dtype=np.float64)
+    
+    for i, m in enumerate(metal_keys):
+        met_table = model_cube[m].data
+        for j, a in enumerate(age_keys):
+            ssp_cube[i, j] = met_table[a]
+    
+    return metal_keys, age_keys, wl, ssp_cube
+
+def _read_fitsio_grid(file_name):
+    """
+    Reads the metallicity keys, age keys, wavelength array, and SSP spectra (as a [metallicity, age, wavelength] array) out of a FITS model cube using fitsio, which parses binary tables considerably faster than astropy.
+    """
+    
+    with fitsio.FITS(file_name) as f:
+        metal_keys = [f[k].get_extname() for k in range(1, len(f))]
+        tables = [f[k].read() for k in range(1, len(f))]
+    
+    age_keys = list(tables[0].dtype.names[1:])
+    wl = np.array(tables[0]['WL'], dtype=np.float64)
+    
+    ssp_cube = np.empty((len(metal_keys), len(age_keys), len(wl)), dtype=np.float64)
+    
+    for i, met_table in enumerate(tables):
+        for j, a in enumerate(age_keys):
+            ssp_cube[i, j] = met_table[a]
+    
+    return metal_keys, age_keys, wl, ssp_cube
+
+def _read_hdf5_grid(model_cube):
+    """
+    Reads the metallicity keys, age keys, wavelength array, and SSP spectra (as a [metallicity, age, wavelength] array) out of an HDF5 model cube.
+    """
+    
+    metal_keys = [k.decode() for k in model_cube['metallicity_keys'][()]]
+    age_keys = [k.decode() for k in model_cube['age_keys'][()]]
+    wl = np.array(model_cube['wavelength'], dtype=np.float64)
+    ssp_cube = np.array(model_cube['ssp'], dtype=np.float64)
+    
+    return metal_keys, age_keys, wl, ssp_cube
+
+def _cube_file_name(model_cube):
+    """
+    Returns the name of the file a model cube was loaded from, or None if it only exists in memory.
+    """
+    
+    if isinstance(model_cube, h5py.File):
+        return model_cube.filename
+    elif isinstance(model_cube, fits.HDUList):
+        return model_cube.filename()
+    
+    return None
 
 def _ingest_model_grid(model_cube):
     """
     Creates the metallicity and age dictionaries that are needed to translate between MCMC samples and discrete age+Z combos that exist in the model cube.
 
+    The SSP spectra themselves are copied into a single contiguous array in native byte order, indexed by [metallicity, age, wavelength], so that looking up a model does not go through the FITS record arrays. The array is kept in single precision, which halves the memory traffic of building the models; they are rescaled, reddened, and compared with the data in double precision. Both grid axes are sorted in ascending order, so the position of a grid point in the sorted grid values is also its index in the array.
+
 
     Parameters
     ----------
-    model_cube : FITS
-        Multi-extension FITS cube containing SSP models
+    model_cube : FITS or h5py File
+        Multi-extension FITS cube or HDF5 file containing SSP models
     """
 
     global metal_dict, age_dict
+    global _age_keys_sorted, _age_vals_sorted, _met_keys_sorted, _met_vals_sorted
+    global _ssp_cube, _wl, _met_key_to_idx, _age_key_to_idx, _met_grid, _age_grid
     
-    metal_dict = {}
-    age_dict = {}
+    if isinstance(model_cube, h5py.File):
+        metal_headers, age_keys, _wl, ssp_cube = _read_hdf5_grid(model_cube)
+    elif _HAS_FITSIO and _cube_file_name(model_cube) is not None:
+        metal_headers, age_keys, _wl, ssp_cube = _read_fitsio_grid(_cube_file_name(model_cube))
+    else:
+        metal_headers, age_keys, _wl, ssp_cube = _read_fits_grid(model_cube)
     
-    example_table = model_cube[1].data
+    age_dict = {a : float(a) for a in age_keys}
+    metal_dict = dict(zip(metal_headers, _interpret_metallicity_keys(metal_headers)))
     
-    for a in example_table.names[1:]:
-        age_dict[a] = float(a)
-        
-    metal_headers = [model_cube[k].header['EXTNAME'] for k in range(1, len(model_cube))]
-    metal_values = _interpret_metallicity_keys(model_cube)
-    metal_dict = dict(zip(metal_headers, metal_values))
+    # Grid values sorted in ascending order (with their keys alongside), so that the nearest grid point can be found by bisection
+    _age_keys_sorted, _age_vals_sorted = _sort_grid(age_dict)
+    _met_keys_sorted, _met_vals_sorted = _sort_grid(metal_dict)
+    
+    _met_key_to_idx = {m : i for i, m in enumerate(_met_keys_sorted)}
+    _age_key_to_idx = {a : j for j, a in enumerate(_age_keys_sorted)}
+    
+    met_order = [metal_headers.index(m) for m in _met_keys_sorted]
+    age_order = [age_keys.index(a) for a in _age_keys_sorted]
+    _ssp_cube = np.ascontiguousarray(ssp_cube[met_order][:, age_order], dtype=np.float32)
+    
+    _met_grid = np.array(_met_vals_sorted)
+    _age_grid = np.array(_age_vals_sorted)
+    
+    if use_gpu:
+        _upload_ssp_cube()
+    
+    if _HAS_NUMBA and not use_gpu:
+        # Compile the model kernel now rather than on the first step of the MCMC run, going through
+        # _combine_models() so that the argument types and layouts are exactly those of a run
+        zero, idx = np.zeros(1), np.zeros(1, dtype=np.intp)
+        for dtype in (np.float64, np.float32):
+            ctx = {'log_trans' : np.zeros(len(_wl), dtype=dtype), 'nebcont' : np.zeros(len(_wl), dtype=dtype)}
+            _combine_models(idx, idx, zero, zero, None, ctx)
+    
+    _remember_model_cube(model_cube)
+
+# Module state set up by _ingest_model_grid(), other than the SSP spectra in _ssp_cube
+_GRID_STATE = ('metal_dict', 'age_dict', '_age_keys_sorted', '_age_vals_sorted', '_met_keys_sorted', '_met_vals_sorted', 
+               '_wl', '_met_key_to_idx', '_age_key_to_idx', '_met_grid', '_age_grid')
+
+def _get_grid_state():
+    """
+    Returns the model grid set up by _ingest_model_grid(), apart from the SSP spectra, as a dict that can be sent to another process.
+    """
+    
+    return {name : globals()[name] for name in _GRID_STATE}
+
+def _set_grid_state(grid_state, ssp_cube):
+    """
+    Installs a model grid from _get_grid_state() together with its SSP spectra, without reading the model cube again.
+    """
+    
+    global _ssp_cube
+    
+    globals().update(grid_state)
+    _ssp_cube = ssp_cube
+    
+    if use_gpu:
+        _upload_ssp_cube()
+
+# The ingested grid of every model cube that is still open, keyed by id(), so that several model suites can be used side by side
+_cube_grids = {}
+
+# id() of the model cube whose grid is currently installed in the module state
+_active_cube_id = None
+
+def _remember_model_cube(model_cube):
+    """
+    Stores the grid just set up by _ingest_model_grid() for ``model_cube``, and marks it as the installed grid. The entry is dropped when the cube is garbage collected.
+    """
+    
+    global _active_cube_id
+    
+    key = id(model_cube)
+    if key not in _cube_grids:
+        weakref.finalize(model_cube, _cube_grids.pop, key, None)
+    
+    _cube_grids[key] = (_get_grid_state(), _ssp_cube)
+    _active_cube_id = key
+
+def _select_model_cube(model_cube):
+    """
+    Installs the grid of ``model_cube`` in the module state, unless it is installed already. A cube that was not loaded with load_ssp_cube() is ingested on first use.
+
+    ``model_cube`` may be None, in which case the installed grid is used; this is how pool workers, which receive the grid through _set_grid_state(), call the model functions.
+    """
+    
+    global _active_cube_id
+    
+    if model_cube is None or id(model_cube) == _active_cube_id:
+        return
+    
+    if id(model_cube) in _cube_grids:
+        _set_grid_state(*_cube_grids[id(model_cube)])
+        _active_cube_id = id(model_cube)
+    else:
+        _ingest_model_grid(model_cube)
+
+def _sort_grid(grid_dict):
+    """
+    Splits a grid dictionary into a list of keys and a list of values, both sorted by value.
+    """
+    
+    items = sorted(grid_dict.items(), key=lambda kv: kv[1])
+    
+    return [k for k, _ in items], [v for _, v in items]
+
+def _nearest_index(sorted_vals, val):
+    """
+    Returns the index of the entry in the ascending list ``sorted_vals`` that is nearest to ``val``; ties go to the lower entry.
+    """
+    
+    i = bisect.bisect_left(sorted_vals, val)
+    
+    if i == 0:
+        return 0
+    if i == len(sorted_vals):
+        return i - 1
+    
+    return i - 1 if val - sorted_vals[i-1] <= sorted_vals[i] - val else i
 
 #########################
 
@@ -141,10 +389,8 @@ def _nearest_age(logt):
     best_t : float
         Dict value for nearest age
     """
-    global age_dict
-
-    best_t_key, best_t = min(age_dict.items(), key=lambda x: abs(logt - x[1]))
-    return best_t_key, best_t
+    j = _nearest_index(_age_vals_sorted, logt)
+    return _age_keys_sorted[j], _age_vals_sorted[j]
 
 def _nearest_metallicity(logZ):
     """
@@ -164,11 +410,9 @@ def _nearest_metallicity(logZ):
         Dict value for nearest metallicity
     """
 
-    global metal_dict
-
     Z = 10**logZ
-    best_Z_key, best_Z = min(metal_dict.items(), key=lambda x: abs(Z - x[1]))
-    return best_Z_key, best_Z
+    j = _nearest_index(_met_vals_sorted, Z)
+    return _met_keys_sorted[j], _met_vals_sorted[j]
 
 #########################
 
@@ -191,32 +435,49 @@ def get_mask(windowlist, x):
         Array of bools (1 = use in fit, 0 = do not use)
     """
 
-    mask_array = np.ones(len(x))
+    x = np.asarray(x)
+    windowlist = np.asarray(windowlist, dtype=np.float64).reshape(-1, 2)
     
-    windowmin, windowmax = np.zeros(len(windowlist)), np.zeros(len(windowlist))
+    mask_array = np.ones(len(x), dtype='bool')
     
-    for k in range(len(windowlist)):
-        idxmin = (np.abs(x - windowlist[k][0])).argmin()
-        idxmax = (np.abs(x - windowlist[k][1])).argmin()
-        windowmin[k] += x[idxmin]
-        windowmax[k] += x[idxmax]
-        
-        mask_array[np.where( (x >= windowmin[k]) & (x <= windowmax[k]) )] = 0
+    # The wavelength array is sorted, so the nearest wavelength to every window bound can be found at once
+    idxmin = _nearest_indices(x, windowlist[:, 0])
+    idxmax = _nearest_indices(x, windowlist[:, 1])
+    
+    for lo, hi in zip(idxmin, idxmax):
+        mask_array[lo:hi+1] = False
+    
+    return mask_array
+
+def _nearest_indices(x, values):
+    """
+    Returns the indices of the entries in the ascending array ``x`` that are nearest to each of ``values``; ties go to the lower index.
+    """
+    
+    # A grid with a single point (e.g. one metallicity) has no neighbours to choose between
+    if len(x) == 1:
+        return np.zeros(np.shape(values), dtype=np.intp)
     
-    return np.array(mask_array, dtype='bool')
+    i = np.clip(np.searchsorted(x, values), 1, len(x) - 1)
+    
+    return np.where(values - x[i-1] <= x[i] - values, i - 1, i)
 
 #########################
 
-def set_ext_law(ext_curve):
+def set_ext_law(ext_curve, x = None):
     """
     Sets the curve used to extinguish model spectra. 
 
     Currently implemented options for extinction curves include 5 Milky Way-like curves (CCM, Fitzpatrick99, ODonnell, FitzMassa07, Gordon23), a starburst galaxy curve (Calzetti), an LMC-like curve (LMC), and an SMC-like curve (SMC).
 
+    If the wavelength array is given, the curve is evaluated on it right away, and apply_ext_law() is specialized to it.
+
     Parameters
     ----------
     ext_curve : str
         Name of extinction curve. Must match an implemented option in SESAMME's library.
+    x : array-like
+        Wavelength array; optional
 
     Raises
     ------
@@ -224,7 +485,7 @@ def set_ext_law(ext_curve):
         String ext_curve is not in the list of allowable values
     """ 
     
-    global use_ext_law
+    global use_ext_law, _apply_ext_law_fn
     
     if ext_curve not in ['CCM', 'Fitzpatrick99', 'ODonnell', 'FitzMassa07', 'Gordon23',
                            'Calzetti', 'SMC', 'LMC']:
@@ -232,12 +493,232 @@ def set_ext_law(ext_curve):
 Accepted values are 'CCM', 'Fitzpatrick99', 'ODonnell', 'FitzMassa07', 'Gordon23', Calzetti', 'LMC', and 'SMC'.")
     
     use_ext_law = ext_curve
+    _apply_ext_law_fn = _make_ext_law(x)
     
     print("Model spectra will now be reddened assuming the", ext_curve, "extinction curve")
 
 #########################
 
-def apply_ext_law(x, ebv, y_model):
+def set_gpu(enable = True):
+    """
+    Sets whether model spectra are built on the GPU. Requires CuPy.
+
+    With the GPU enabled, the SSP model cube is kept in device memory and the models of all walkers are built there in a single kernel launch; only the walker parameters and the finished models cross between host and device.
+
+    Parameters
+    ----------
+    enable : Boolean
+        Determines whether to build model spectra on the GPU
+
+    Raises
+    ------
+    ImportError
+        enable is True but CuPy is not installed
+    """
+    
+    global use_gpu
+    
+    if enable:
+        _load_cupy()
+    
+    use_gpu = bool(enable)
+    
+    if use_gpu and '_ssp_cube' in globals():
+        _upload_ssp_cube()
+    
+    print("Model spectra will now be built on the", "GPU" if use_gpu else "CPU")
+
+def _load_cupy():
+    """
+    Imports CuPy and compiles the GPU model kernel, the first time it is called.
+    """
+    
+    global cp, _eval_models_gpu
+    
+    if cp is not None:
+        return
+    
+    try:
+        import cupy
+    except ImportError:
+        raise ImportError("Building models on the GPU requires CuPy (https://cupy.dev).")
+    
+    # Same arithmetic as _eval_models(), with one GPU thread per (walker, wavelength) element
+    _eval_models_gpu = cupy.ElementwiseKernel(
+        'raw float64 params, raw float32 ssp_cube, raw T nebcont, raw T log_trans, int64 n_walk, int64 n_age, int64 n_wl',
+        'T red_model',
+        '''
+        const long long j = i / n_wl;
+        const long long k = i % n_wl;
+        const long long m = (long long)params[j];
+        const long long a = (long long)params[n_walk + j];
+        red_model = (params[3*n_walk + j] * ssp_cube[(m * n_age + a) * n_wl + k] + params[4*n_walk + j] * nebcont[k]) * exp(params[2*n_walk + j] * log_trans[k]);
+        ''',
+        'sesamme_eval_models')
+    
+    cp = cupy
+
+def _upload_ssp_cube():
+    """
+    Copies the current SSP model cube to device memory.
+    """
+    
+    global _ssp_cube_gpu
+    
+    _ssp_cube_gpu = cp.asarray(_ssp_cube)
+
+#########################
+
+def _extinction_per_ebv(x):
+    """
+    Evaluate the active extinction curve for E(B-V) = 1.
+
+    Every implemented curve is linear in A_V, so the extinction for any other E(B-V) is this array multiplied by E(B-V).
+    
+    Parameters
+    ----------
+    x : array-like
+        Wavelength array
+
+    Returns
+    -------
+    ext_mag : np.ndarray
+        Extinction in magnitudes at each wavelength for E(B-V) = 1
+    """
+    
+    x = np.asarray(x, dtype=np.float64)
+    
+    if use_ext_law == "CCM":
+        ext_mag = extinction.ccm89(x, 3.1, 3.1)
+        
+    elif use_ext_law == "Fitzpatrick99":
+        ext_mag = extinction.fitzpatrick99(x, 3.1, 3.1)
+        
+    elif use_ext_law == "ODonnell":
+        ext_mag = extinction.odonnell94(x, 3.1, 3.1)
+        
+    elif use_ext_law == "FitzMassa07":
+        ext_mag = extinction.fm07(x, 3.1)
+        
+    elif use_ext_law == "Calzetti":
+        ext_mag = extinction.calzetti00(x, 4.05, 4.05)
+    
+    elif use_ext_law == 'Gordon23':
+        ext_mag = _dust_extinction_per_ebv(G23(Rv = 3.1), x)
+        
+    elif use_ext_law == 'LMC':
+        ext_mag = _dust_extinction_per_ebv(G03_LMCAvg(), x)
+    
+    elif use_ext_law == 'SMC':
+        ext_mag = _dust_extinction_per_ebv(G03_SMCBar(), x)
+    
+    else:
+        raise ValueError("'"+use_ext_law+"'" +" is not a valid choice of extinction law.\n \
+Accepted values are 'CCM', 'Fitzpatrick99', 'ODonnell', 'FitzMassa07', 'Gordon23', Calzetti', 'LMC', and 'SMC'.")
+        
+    return np.asarray(ext_mag, dtype=np.float64)
+
+def _dust_extinction_per_ebv(ext_curve, x):
+    """
+    Evaluate a ``dust_extinction`` curve for E(B-V) = 1 on the wavelength array ``x`` (in Angstroms).
+
+    The curve's evaluate() method is called directly with the wavenumbers in inverse microns, which skips the unit conversion and input checks of calling the model itself, and returns a plain array.
+    """
+    
+    return ext_curve.evaluate(1e4 / x / u.micron, *ext_curve.parameters) * ext_curve.Rv
+
+def _cache_matches(cache, x, **keys):
+    """
+    Returns True if ``cache`` was filled for the wavelength array ``x`` and for the given values of ``keys``; callers record these in the cache once it is refilled.
+
+    Wavelength arrays are matched by identity, which is cheap enough to check on every call. Only the most recent array is kept, and the cache does not notice if ``x`` is modified in place. Holding on to ``x`` itself means its identity cannot be reused by a different array.
+    """
+    
+    return cache['x'] is x and all(cache[k] == v for k, v in keys.items())
+
+_ext_cache = {'x' : None, 'ext_law' : None, 'ext_mag' : None, 'log_trans' : None}
+
+def precompute_ext_law(x):
+    """
+    Evaluate the active extinction curve for E(B-V) = 1 on the wavelength array ``x``, and cache the result.
+
+    Calling this again with the same array object (and the same extinction law) returns the cached curve, so apply_ext_law() only has to scale it by E(B-V). The natural log of the corresponding transmission is cached alongside it, so that reddening takes a single exp() per wavelength. See _cache_matches() for how wavelength arrays are matched.
+
+    Parameters
+    ----------
+    x : array-like
+        Wavelength array
+
+    Returns
+    -------
+    ext_mag : np.ndarray
+        Extinction in magnitudes at each wavelength for E(B-V) = 1
+    """
+    
+    if not _cache_matches(_ext_cache, x, ext_law = use_ext_law):
+        _ext_cache['ext_mag'] = _extinction_per_ebv(x)
+        _ext_cache['log_trans'] = -0.4 * np.log(10) * _ext_cache['ext_mag']
+        _ext_cache.update(x = x, ext_law = use_ext_law)
+    
+    return _ext_cache['ext_mag']
+
+#########################
+
+def build_model_context(x, dtype = np.float64):
+    """
+    Precompute everything about a model spectrum that depends on the wavelength grid but not on the model parameters.
+
+    The result can be passed to get_model() (and friends) as ``ctx`` so that this work is done once per MCMC run rather than on every walker step. It must be rebuilt if the extinction law is changed.
+
+    Parameters
+    ----------
+    x : array-like
+        Wavelength array
+    dtype : data-type
+        Floating-point type of the wavelength-dependent arrays, and hence of the models built with this context; optional
+
+    Returns
+    -------
+    ctx : dict
+        Contains the active extinction law ('ext_law'), its extinction in magnitudes per unit E(B-V) ('ext_mag') and the natural log of the corresponding transmission ('log_trans'), and the unscaled nebular continuum interpolated onto ``x`` ('nebcont')
+
+    Raises
+    ------
+    ValueError
+        ``x`` is not the wavelength grid of the model cube
+    """
+    
+    _check_wavelength_grid(x)
+    
+    ctx = {'ext_law' : use_ext_law, 
+           'ext_mag' : precompute_ext_law(x), 
+           'log_trans' : _ext_cache['log_trans'].astype(dtype, copy=False),
+           'nebcont' : precompute_nebular(x).astype(dtype, copy=False)}
+    
+    return ctx
+
+def _check_wavelength_grid(x, ctx = None):
+    """
+    Raises a ValueError unless ``x`` (and the model context ``ctx``, if given) has as many points as the wavelength grid of the loaded model cube. The models are built bin by bin from the cube, so the data must be sampled on the same grid.
+
+    Without ``ctx``, i.e. when a context is about to be built, the wavelengths themselves are compared with the grid as well; that comparison is only made once per context.
+    """
+    
+    if '_wl' not in globals():
+        return
+    
+    for n in [len(x)] + ([] if ctx is None else [len(ctx['log_trans'])]):
+        if n != len(_wl):
+            raise ValueError("The wavelength array has "+str(n)+" points, but the model cube has "+str(len(_wl))+".\n \
+Data must be resampled onto the wavelength grid of the SSP models before fitting.")
+    
+    if ctx is None and not np.allclose(x, _wl):
+        raise ValueError("The wavelength array does not match the wavelength grid of the model cube.\n \
+Data must be resampled onto the wavelength grid of the SSP models before fitting.")
+
+#########################
+
+def apply_ext_law(x, ebv, y_model, ctx=None):
     """
     Redden a model spectrum for comparison with the data. 
     
@@ -249,6 +730,8 @@ def apply_ext_law(x, ebv, y_model):
         Value of E(B-V) by which to redden the model
     y_model : np.ndarray
         Flux array of the model spectrum; may be purely stellar or stellar + nebular continuum
+    ctx : dict
+        Precomputed wavelength-dependent quantities from build_model_context(); optional. If not given, the extinction curve cached by precompute_ext_law() is used.
 
     Returns
     -------
@@ -262,43 +745,40 @@ def apply_ext_law(x, ebv, y_model):
 
     """    
     
-    if use_ext_law not in ['CCM', 'Fitzpatrick99', 'ODonnell', 'FitzMassa07', 'Gordon23',
-                           'Calzetti', 'SMC', 'LMC']:
-        raise ValueError("'"+use_ext_law+"'" +" is not a valid choice of extinction law.\n \
-Accepted values are 'CCM', 'Fitzpatrick99', 'ODonnell', 'FitzMassa07', 'Gordon23', Calzetti', 'LMC', and 'SMC'.")
-        
-    elif use_ext_law == "CCM":
-        red_model = extinction.apply(extinction.ccm89(x, ebv*3.1, 3.1), y_model)
-        
-    elif use_ext_law == "Fitzpatrick99":
-        red_model = extinction.apply(extinction.fitzpatrick99(x, ebv*3.1, 3.1), y_model)
-        
-    elif use_ext_law == "ODonnell":
-        red_model = extinction.apply(extinction.odonnell94(x, ebv*3.1, 3.1), y_model)
-        
-    elif use_ext_law == "FitzMassa07":
-        red_model = extinction.apply(extinction.fm07(x, ebv*3.1), y_model)
-        
-    elif use_ext_law == "Calzetti":
-        red_model = extinction.apply(extinction.calzetti00(x, ebv*4.05, 4.05), y_model)
+    if ctx is not None:
+        return y_model * np.exp(ebv * ctx['log_trans'])
     
-    elif use_ext_law == 'Gordon23':
-        ext_curve = G23(Rv = 3.1)
-        red_model = y_model * ext_curve.extinguish(x * u.AA, ebv * ext_curve.Rv)
-        
-    elif use_ext_law == 'LMC':
-        ext_curve = G03_LMCAvg()
-        red_model = y_model * ext_curve.extinguish(x * u.AA, ebv * ext_curve.Rv)
+    return _apply_ext_law_fn(x, ebv, y_model)
+
+def _make_ext_law(x_fixed = None):
+    """
+    Builds the function that apply_ext_law() hands over to when no model context is given, for the current extinction law.
+
+    If ``x_fixed`` is given, the curve is evaluated on it once and the returned function reddens with it directly whenever it is called with that same array; any other wavelength array goes through precompute_ext_law().
+    """
     
-    elif use_ext_law == 'SMC':
-        ext_curve = G03_SMCBar()
-        red_model = y_model * ext_curve.extinguish(x * u.AA, ebv * ext_curve.Rv)
-        
-    return red_model
+    def _apply_cached(x, ebv, y_model):
+        precompute_ext_law(x)
+        return y_model * np.exp(ebv * _ext_cache['log_trans'])
+    
+    if x_fixed is None:
+        return _apply_cached
+    
+    precompute_ext_law(x_fixed)
+    log_trans = _ext_cache['log_trans']
+    
+    def _apply_fixed(x, ebv, y_model):
+        if x is x_fixed:
+            return y_model * np.exp(ebv * log_trans)
+        return _apply_cached(x, ebv, y_model)
+    
+    return _apply_fixed
+
+_apply_ext_law_fn = _make_ext_law()
 
 #########################
 
-def get_model(theta, x, model_cube, ion_table, add_nebular = True):
+def get_model(theta, x, model_cube, ion_table, add_nebular = True, ctx = None):
     """
     Construct a model star cluster spectrum with values of metallicity, age, extinction, and normalization randomly chosen (within bounds).
 
@@ -314,30 +794,216 @@ def get_model(theta, x, model_cube, ion_table, add_nebular = True):
         Table object containing ionizing fluxes per SSP
     add_nebular : Boolean
         Determines whether to add nebular continuum emission to a model
+    ctx : dict
+        Precomputed wavelength-dependent quantities from build_model_context(); optional
 
     Returns
     -------
     red_nearest_model : array-like
         Extinguished and rescaled SSP or SSP+nebular model spectrum with age and metallicity values nearest to the inputs. 
+
+    Raises
+    ------
+    ValueError
+        ``x`` is not the wavelength grid of the model cube
     """
     
-    logt, logZ, ebv, ampl = theta
+    _select_model_cube(model_cube)
     
-    met_key, met = _nearest_metallicity(logZ)
-    age_key, age = _nearest_age(logt)
+    if ctx is None:
+        ctx = build_model_context(x)
+    else:
+        _check_wavelength_grid(x, ctx)
+    
+    red_nearest_model = get_model_batch_fn(add_nebular)(np.atleast_2d(np.asarray(theta, dtype=np.float64)), x, model_cube, ion_table, ctx)[0]
+    
+    return red_nearest_model
+
+#########################
+
+def get_model_batch(thetas, x, model_cube, ion_table, add_nebular = True, ctx = None):
+    """
+    Construct model star cluster spectra for a whole ensemble of walkers at once; the batched equivalent of get_model().
+
+    The nearest models of all walkers are looked up, rescaled, given their nebular continuum, and reddened at once (in a single compiled pass if Numba is installed).
+
+    Parameters
+    ----------
+    thetas : np.ndarray
+        Array of shape (nwalkers, 4); each row contains, in order, a log(age) logt, a log(metallicity) logZ, an E(B-V) value ebv, and an amplitude log(ampl).
+    x : array-like
+        Wavelength array
+    model_cube : FITS
+        Multi-extension FITS cube containing SSP models
+    ion_table : astropy Table
+        Table object containing ionizing fluxes per SSP
+    add_nebular : Boolean
+        Determines whether to add nebular continuum emission to the models
+    ctx : dict
+        Precomputed wavelength-dependent quantities from build_model_context(); optional. Computed on the fly if not given.
+
+    Returns
+    -------
+    red_nearest_models : np.ndarray
+        Array of shape (nwalkers, len(x)) holding the extinguished and rescaled SSP or SSP+nebular model spectrum of each walker.
+
+    Raises
+    ------
+    ValueError
+        ``x`` is not the wavelength grid of the model cube
+    """
     
-    nearest_stellar_model = (10**ampl) * model_cube[met_key].data[age_key]
-    specwl = model_cube[met_key].data['WL'].byteswap().newbyteorder()
+    thetas = np.atleast_2d(thetas)
+    if len(thetas) == 0:
+        return np.empty((0, len(x)))
+    
+    _select_model_cube(model_cube)
+    
+    if ctx is None:
+        ctx = build_model_context(x)
+    else:
+        _check_wavelength_grid(x, ctx)
+    
+    return get_model_batch_fn(add_nebular)(thetas, x, model_cube, ion_table, ctx)
+
+def get_model_batch_fn(add_nebular = True):
+    """
+    Select the variant of get_model_batch() that matches ``add_nebular``, so that the choice is made once per MCMC run rather than on every call.
+
+    The returned function takes ``(thetas, x, model_cube, ion_table, ctx)``, where ``thetas`` must be a non-empty 2D array and ``ctx`` is required. If ``model_cube`` is None, the grid currently installed in the module state is used.
+
+    Parameters
+    ----------
+    add_nebular : Boolean
+        Determines whether the models include nebular continuum emission
+
+    Returns
+    -------
+    model_fn : function
+        Batched model function with or without the nebular continuum
+    """
     
     if add_nebular == True:
-        nebcont = nebular_continuum(x, theta, ion_table)
-        nearest_model = nearest_stellar_model + nebcont
+        return _get_model_batch_with_neb
     else:
-        nearest_model = nearest_stellar_model
+        return _get_model_batch_no_neb
+
+def _nearest_grid_batch(thetas):
+    """
+    Look up the nearest SSP model of every walker at once; the batched equivalent of _nearest_age() and _nearest_metallicity().
+
+    Returns the integer metallicity and age indices into _ssp_cube.
+    """
     
-    red_nearest_model = apply_ext_law(x, ebv, nearest_model)        
+    met_idx = _nearest_indices(_met_grid, 10**thetas[:, 1])
+    age_idx = _nearest_indices(_age_grid, thetas[:, 0])
     
-    return red_nearest_model
+    return met_idx, age_idx
+
+def _get_model_batch_no_neb(thetas, x, model_cube, ion_table, ctx):
+    """Purely stellar variant of get_model_batch(); see get_model_batch_fn()."""
+    
+    _select_model_cube(model_cube)
+    met_idx, age_idx = _nearest_grid_batch(thetas)
+    
+    return _combine_models(met_idx, age_idx, thetas[:, 2], 10**thetas[:, 3], None, ctx)
+
+def _get_model_batch_with_neb(thetas, x, model_cube, ion_table, ctx):
+    """Stellar + nebular continuum variant of get_model_batch(); see get_model_batch_fn()."""
+    
+    _select_model_cube(model_cube)
+    met_idx, age_idx = _nearest_grid_batch(thetas)
+    
+    ampl = 10**thetas[:, 3]
+    
+    return _combine_models(met_idx, age_idx, thetas[:, 2], ampl, ampl * _neb_prefactor(ion_table)[met_idx, age_idx], ctx)
+
+def _combine_models(met_idx, age_idx, ebv, stellar_scale, neb_scale, ctx):
+    """
+    Rescale the selected SSP models, add the rescaled nebular continuum (unless ``neb_scale`` is None), and redden each walker's model by its E(B-V).
+
+    Returns the (nwalkers, len(x)) array of models, in the floating-point type of ``ctx``.
+    """
+    
+    if use_gpu:
+        return _combine_models_gpu(met_idx, age_idx, ebv, stellar_scale, neb_scale, ctx)
+    
+    dtype = ctx['log_trans'].dtype
+    
+    if _HAS_NUMBA:
+        if neb_scale is None:
+            neb_scale = np.zeros_like(stellar_scale)
+        red_models = np.empty((len(met_idx), len(ctx['log_trans'])), dtype=dtype)
+        # ebv is usually a column of the walker positions, so it is made contiguous to match the compiled kernel
+        return _eval_models(met_idx, age_idx, np.ascontiguousarray(ebv), stellar_scale, neb_scale, _ssp_cube, ctx['nebcont'], ctx['log_trans'], red_models)
+    
+    nearest_models = stellar_scale.astype(dtype)[:, None] * _ssp_cube[met_idx, age_idx]
+    
+    if neb_scale is not None:
+        nearest_models += ctx['nebcont'][None, :] * neb_scale.astype(dtype)[:, None]
+    
+    # The transmission for a given E(B-V) is exp(ebv * log_trans), which is cheaper than raising 10 to a power
+    nearest_models *= np.exp(ebv.astype(dtype)[:, None] * ctx['log_trans'][None, :])
+    
+    return nearest_models
+
+def _eval_models(met_idx, age_idx, ebv, stellar_scale, neb_scale, ssp_cube, nebcont, log_trans, red_models):
+    """
+    Build the reddened stellar + nebular model of every walker in a single pass over the wavelength grid.
+    
+    Written as explicit loops so that it can be compiled with Numba; it is only used when Numba is available.
+    
+    Parameters
+    ----------
+    met_idx, age_idx : np.ndarray
+        Indices of each walker's nearest SSP model in ``ssp_cube``
+    ebv : np.ndarray
+        E(B-V) of each walker
+    stellar_scale, neb_scale : np.ndarray
+        Factors by which to rescale the SSP model and the nebular continuum of each walker
+    ssp_cube : np.ndarray
+        SSP models indexed by [metallicity, age, wavelength], in single precision
+    nebcont : np.ndarray
+        Unscaled nebular continuum on the wavelength grid
+    log_trans : np.ndarray
+        Natural log of the transmission for E(B-V) = 1 on the wavelength grid
+    red_models : np.ndarray
+        Array of shape (nwalkers, len(x)) to be filled with the models; its floating-point type sets that of the result
+
+    Returns
+    -------
+    red_models : np.ndarray
+        Array of shape (nwalkers, len(x)) holding the model of each walker
+    """
+    for j in range(met_idx.size):
+        m, a = met_idx[j], age_idx[j]
+        for i in range(log_trans.size):
+            red_models[j, i] = (stellar_scale[j] * ssp_cube[m, a, i] + neb_scale[j] * nebcont[i]) * np.exp(ebv[j] * log_trans[i])
+    
+    return red_models
+
+if _HAS_NUMBA:
+    _eval_models = njit(fastmath=True, cache=True)(_eval_models)
+
+def _combine_models_gpu(met_idx, age_idx, ebv, stellar_scale, neb_scale, ctx):
+    """
+    GPU version of _combine_models(). The wavelength-dependent arrays of ``ctx`` are copied to the device once and kept in ``ctx``.
+    """
+    
+    if 'gpu' not in ctx:
+        ctx['gpu'] = (cp.asarray(ctx['nebcont']), cp.asarray(ctx['log_trans']))
+    nebcont, log_trans = ctx['gpu']
+    
+    if neb_scale is None:
+        neb_scale = np.zeros_like(stellar_scale)
+    
+    # The walker parameters are packed together so that they are sent to the device in one transfer
+    params = cp.asarray(np.stack([met_idx, age_idx, ebv, stellar_scale, neb_scale]).astype(np.float64))
+    red_models = cp.empty((len(met_idx), log_trans.size), dtype=log_trans.dtype)
+    
+    _eval_models_gpu(params, _ssp_cube_gpu, nebcont, log_trans, len(met_idx), _ssp_cube_gpu.shape[1], log_trans.size, red_models)
+    
+    return cp.asnumpy(red_models)
 
 #########################
 
@@ -353,7 +1019,7 @@ Qbase = 52
 sparse_nebcont = (2.998e18 * gamma * 10**(Qbase)) / (alpha_B * nebx**2)
 
 
-def nebular_continuum(x, theta, ion_table):
+def nebular_continuum(x, theta, ion_table, ctx=None):
     """
     Python equivalent of the Starburst99 function CONTINUUM, for computing the approximate nebular continuum.
     
@@ -367,6 +1033,8 @@ def nebular_continuum(x, theta, ion_table):
         Array containing, in order, a log(age) logt, a log(metallicity) logZ, an E(B-V) value ebv, and an amplitude log(ampl).
     ion_table : astropy Table
         Table object containing ionizing fluxes per SSP
+    ctx : dict
+        Precomputed wavelength-dependent quantities from build_model_context(); optional
 
     Returns
     -------
@@ -378,12 +1046,92 @@ def nebular_continuum(x, theta, ion_table):
     met_key, met = _nearest_metallicity(logZ)
     age_key, age = _nearest_age(logt)
     
-    # Interpolate the sparsely-sampled continuum to the wavelength grid of the model
-    interp_function = interpolate.interp1d(nebx, sparse_nebcont, fill_value='extrapolate', )
-    interp_nebcont = interp_function(x) / 3.83e33
+    # The continuum interpolated to the wavelength grid of the model only depends on x, so it is only computed once
+    if ctx is not None:
+        interp_nebcont = ctx['nebcont']
+    else:
+        interp_nebcont = precompute_nebular(x)
     
     # Rescale the continuum by the emissivity of the nearest model and by the specified amplitude parameter
-    Q_new = ion_table[ion_table['Z'] == met_key][age_key] 
-    interp_nebcont = interp_nebcont * (10**(Q_new - Qbase + ampl))  
+    prefactor = _neb_prefactor(ion_table)[_met_key_to_idx[met_key], _age_key_to_idx[age_key]]
+    interp_nebcont = interp_nebcont * (prefactor * 10**ampl)
+    
+    return interp_nebcont
+
+_neb_cache = {'x' : None, 'bins' : None, 't' : None, 'sparse_nebcont' : None, 'nebcont' : None}
+_ion_cache = {'ion_table' : None, 'ssp_cube' : None, 'Q' : None, 'prefactor' : None}
+
+def precompute_nebular(x):
+    """
+    Interpolate the unscaled nebular continuum onto the wavelength array ``x``, and cache the result.
+
+    Calling this again with the same array object returns the cached continuum, so nebular_continuum() only has to rescale it. The (linear) interpolation weights are cached as well, so if ``sparse_nebcont`` is replaced, the continuum is recomputed without searching the wavelength grid again. Beyond either end of ``nebx``, the continuum is extrapolated from the nearest pair of points. See _cache_matches() for how wavelength arrays are matched.
+
+    Parameters
+    ----------
+    x : array-like
+        Wavelength array
+
+    Returns
+    -------
+    interp_nebcont : np.ndarray
+        Nebular continuum for Q = 10**Qbase ionizing photons per second, in Solar luminosities per A
+    """
+    
+    if not _cache_matches(_neb_cache, x):
+        xa = np.asarray(x, dtype=np.float64)
+        bins = np.clip(np.searchsorted(nebx, xa) - 1, 0, len(nebx) - 2)
+        
+        _neb_cache['bins'] = bins
+        _neb_cache['t'] = (xa - nebx[bins]) / (nebx[bins+1] - nebx[bins])
+        _neb_cache.update(x = x, sparse_nebcont = None)
+    
+    if _neb_cache['sparse_nebcont'] is not sparse_nebcont:
+        bins, t = _neb_cache['bins'], _neb_cache['t']
+        # 10**Qbase is a Python int too large for int64, so sparse_nebcont comes out as an object array
+        sparse = np.asarray(sparse_nebcont, dtype=np.float64)
+        _neb_cache['nebcont'] = ((1 - t) * sparse[bins] + t * sparse[bins+1]) / 3.83e33
+        _neb_cache['sparse_nebcont'] = sparse_nebcont
+    
+    return _neb_cache['nebcont']
+
+def _ion_matrix(ion_table):
+    """
+    Rearranges the ionizing photon outputs of ``ion_table`` into an array indexed by [metallicity, age] in the same order as _ssp_cube, and caches it.
+
+    The array is rebuilt whenever a different ionization table or model cube is used. Grid points missing from the table are NaN.
+
+    Parameters
+    ----------
+    ion_table : astropy Table
+        Table object containing ionizing fluxes per SSP
+
+    Returns
+    -------
+    Q_matrix : np.ndarray
+        Log of the number of ionizing photons per second of each SSP in the model grid
+    """
+    
+    if _ion_cache['ion_table'] is not ion_table or _ion_cache['ssp_cube'] is not _ssp_cube:
+        Q_matrix = np.full(_ssp_cube.shape[:2], np.nan)
+        
+        # Walk through the rows backwards so that, as with a table lookup, the first row for a metallicity wins
+        for row in ion_table[::-1]:
+            if row['Z'] in _met_key_to_idx:
+                Q_matrix[_met_key_to_idx[row['Z']]] = [row[a] for a in _age_keys_sorted]
+        
+        _ion_cache['Q'] = Q_matrix
+        _ion_cache['prefactor'] = 10**(Q_matrix - Qbase)
+        _ion_cache['ion_table'] = ion_table
+        _ion_cache['ssp_cube'] = _ssp_cube
+    
+    return _ion_cache['Q']
+
+def _neb_prefactor(ion_table):
+    """
+    Returns the factor 10**(Q - Qbase) by which the unscaled nebular continuum of each SSP in the model grid is rescaled (before the amplitude), as an array indexed like _ion_matrix().
+    """
+    
+    _ion_matrix(ion_table)
     
-    return interp_nebcont
\ No newline at end of file
+    return _ion_cache['prefactor']
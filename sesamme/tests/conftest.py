@@ -0,0 +1,43 @@
+import numpy as np
+import pytest
+from astropy.io import fits
+from astropy.table import Table
+
+import sesamme.models as models
+
+#########################
+
+AGES = ['6.0', '6.5', '7.0', '7.5']
+METS = ['Z040', 'Z020', 'Z008', 'Z004', 'Zem4']
+WL = np.arange(1100., 1300., 1.)
+
+def write_cube(file_name, scale=1.):
+    """
+    Writes a small SSP model cube, with ages spaced so that midpoints between them are exact ties.
+    """
+    hdus = [fits.PrimaryHDU()]
+    for i, met in enumerate(METS):
+        cols = [fits.Column(name='WL', format='D', array=WL)]
+        for j, age in enumerate(AGES):
+            cols.append(fits.Column(name=age, format='D', array=scale * (1 + i) * (WL / 1200.)**(-2 - j)))
+        hdu = fits.BinTableHDU.from_columns(cols)
+        hdu.header['EXTNAME'] = met
+        hdus.append(hdu)
+    
+    fits.HDUList(hdus).writeto(file_name)
+
+@pytest.fixture(scope='module')
+def model_cube(tmp_path_factory):
+    file_name = str(tmp_path_factory.mktemp('models') / 'cube.fits')
+    write_cube(file_name)
+    
+    return models.load_ssp_cube(file_name)
+
+@pytest.fixture(scope='module')
+def ion_table():
+    table = Table()
+    table['Z'] = METS
+    for j, age in enumerate(AGES):
+        table[age] = 52.5 - 0.3 * j + 0.01 * np.arange(len(METS))
+    
+    return table
@@ -0,0 +1,221 @@
+import numpy as np
+import emcee
+import pytest
+
+import sesamme.mcmc as mcmc
+import sesamme.models as models
+
+#########################
+
+@pytest.fixture
+def prior_bounds():
+    mcmc.set_prior_bounds(mcmc.prior_dict, mcmc.prior_lowbounds, mcmc.prior_highbounds)
+
+@pytest.fixture
+def small_run(monkeypatch, tmp_path, model_cube, ion_table, prior_bounds):
+    """
+    Returns a function that runs a short fit to a noiseless model spectrum and returns the sampler.
+    """
+    # Restore every setting touched by the setters once the test is over
+    for name in ['nwalkers', 'nsteps', 'autocorr_interval', 'seed', 'initial_pos', 'initial_centers']:
+        monkeypatch.setattr(mcmc, name, getattr(mcmc, name))
+    
+    x = np.arange(1100., 1300., 1.)
+    y = models.get_model([6.5, -2.1, 0.2, -1.0], x, model_cube, ion_table)
+    mask = models.get_mask([[1150., 1160.]], x)
+    
+    def run(seed, nsteps=30, autocorr_interval=0, precision='fp64', name='run'):
+        mcmc.set_walker_size(16)
+        mcmc.set_chain_size(nsteps)
+        mcmc.set_autocorr_interval(autocorr_interval)
+        mcmc.set_seed(seed)
+        return mcmc._run_sesamme_core(str(tmp_path / 'chain.h5'), name, x, y, 0.05 * y, model_cube, ion_table, mask, precision=precision)
+    
+    return run
+
+def _log_prob(theta):
+    return -0.5 * np.sum(theta**2), theta[0]
+
+def test_buffered_backend_reads_back_with_hdf_backend(tmp_path):
+    file_name = str(tmp_path / 'chain.h5')
+    nwalkers, ndim, nsteps = 16, 3, 75
+    
+    # The number of steps is not a multiple of the flush interval, so the last block is only partly filled
+    backend = mcmc._BufferedHDFBackend(file_name, name='test', flush_interval=20)
+    backend.reset(nwalkers, ndim)
+    
+    sampler = emcee.EnsembleSampler(nwalkers, ndim, _log_prob, backend=backend)
+    sampler.run_mcmc(np.random.default_rng(0).normal(size=(nwalkers, ndim)), nsteps)
+    assert backend.iteration == nsteps
+    backend.flush()
+    
+    reader = emcee.backends.HDFBackend(file_name, name='test', read_only=True)
+    
+    assert reader.iteration == nsteps
+    assert reader.shape == (nwalkers, ndim)
+    np.testing.assert_array_equal(reader.get_chain(), sampler.get_chain())
+    np.testing.assert_array_equal(reader.get_log_prob(), sampler.get_log_prob())
+    np.testing.assert_array_equal(reader.get_blobs(), sampler.get_blobs())
+    np.testing.assert_array_equal(reader.accepted, sampler.backend.accepted)
+    
+    state = reader.random_state
+    np.testing.assert_array_equal(state[1], sampler.random_state[1])
+
+def test_buffered_backend_continues_a_run(tmp_path):
+    file_name = str(tmp_path / 'chain.h5')
+    nwalkers, ndim = 8, 2
+    
+    backend = mcmc._BufferedHDFBackend(file_name, name='test', flush_interval=20)
+    backend.reset(nwalkers, ndim)
+    
+    # Both runs end with steps still in the buffer
+    sampler = emcee.EnsembleSampler(nwalkers, ndim, _log_prob, backend=backend)
+    sampler.run_mcmc(np.random.default_rng(0).normal(size=(nwalkers, ndim)), 15)
+    sampler.run_mcmc(None, 15)
+    assert backend.iteration == 30
+    backend.flush()
+    
+    reader = emcee.backends.HDFBackend(file_name, name='test', read_only=True)
+    
+    assert reader.iteration == 30
+    np.testing.assert_array_equal(reader.get_chain(), sampler.get_chain())
+    np.testing.assert_array_equal(reader.get_log_prob(), sampler.get_log_prob())
+
+def test_gpu_and_pool_are_rejected(tmp_path, monkeypatch):
+    monkeypatch.setattr(mcmc, 'nprocs', 2)
+    monkeypatch.setattr(mcmc.models, 'use_gpu', True)
+    
+    with pytest.raises(ValueError):
+        mcmc._run_sesamme_core(str(tmp_path / 'chain.h5'), 'test', None, None, None, None, None, None)
+
+@pytest.mark.parametrize('use_numba', [True, False])
+def test_fp32_likelihood_with_cgs_fluxes(monkeypatch, use_numba):
+    if use_numba and not mcmc._HAS_NUMBA:
+        pytest.skip('Numba is not installed')
+    monkeypatch.setattr(mcmc, '_HAS_NUMBA', use_numba)
+    
+    # Flux densities in erg/s/cm^2/A, for which 1 / yerr**2 overflows single precision
+    rng = np.random.default_rng(3)
+    y = 1e-18 * (1 + rng.uniform(size=500))
+    yerr = 0.02 * y
+    y_model = y * (1 + 0.01 * rng.normal(size=(4, 500)))
+    mask = np.ones(500, dtype=bool)
+    mask[100:150] = False
+    
+    lnl = {}
+    for precision, dtype in mcmc._precision_dtypes.items():
+        y_sel, inv_var_sel, idx, log_err_norm = mcmc._prepare_data(y, yerr, mask, dtype)
+        lnl[precision] = mcmc._log_likelihood(y_sel, inv_var_sel, y_model.astype(dtype), idx, log_err_norm)
+    
+    assert np.all(np.isfinite(lnl['fp32']))
+    np.testing.assert_allclose(lnl['fp32'], lnl['fp64'], rtol=1e-5)
+
+def test_batch_posterior_matches_per_walker(model_cube, ion_table, prior_bounds):
+    x = np.arange(1100., 1300., 1.)
+    y = models.get_model([6.5, -2.1, 0.2, -1.0], x, model_cube, ion_table)
+    yerr = 0.05 * y
+    mask = models.get_mask([[1150., 1160.]], x)
+    
+    # The last two walkers are outside the prior volume
+    rng = np.random.default_rng(5)
+    thetas = np.array([6.5, -2.1, 0.2, -1.0]) + 0.2 * rng.normal(size=(10, 4))
+    thetas[-2:, 2] = [-0.5, 2.]
+    
+    for add_nebular in [True, False]:
+        batch = mcmc.log_posterior_batch(thetas, x, y, yerr, model_cube, ion_table, mask, add_nebular)
+        single = [mcmc.log_posterior(theta, x, y, yerr, model_cube, ion_table, mask, add_nebular) for theta in thetas]
+        
+        np.testing.assert_allclose(batch, single, rtol=1e-12)
+        assert np.all(np.isneginf(batch[-2:]))
+
+def _log_likelihood_reference(y, yerr, y_model, mask):
+    """
+    The original log_likelihood(), with the normalization term computed on every call.
+    """
+    masked_spec = np.array((y[mask] - y_model[mask]) / yerr[mask])
+    masked_err = np.array(np.sqrt(2) * np.sqrt(np.pi) * yerr[mask])
+    
+    return -0.5 * (np.dot(masked_spec, masked_spec) + np.log(np.dot(masked_err, masked_err)))
+
+def test_log_likelihood_matches_original_formula():
+    rng = np.random.default_rng(11)
+    y = 1 + rng.uniform(size=300)
+    yerr = 0.05 * (1 + rng.uniform(size=300))
+    y_models = y * (1 + 0.02 * rng.normal(size=(5, 300)))
+    mask = np.ones(300, dtype=bool)
+    mask[20:60] = False
+    mask[200:210] = False
+    
+    reference = [_log_likelihood_reference(y, yerr, y_model, mask) for y_model in y_models]
+    
+    np.testing.assert_allclose([mcmc.log_likelihood(y, yerr, y_model, mask) for y_model in y_models], reference, rtol=1e-12)
+    np.testing.assert_allclose(mcmc.log_likelihood(y, yerr, y_models, mask), reference, rtol=1e-12)
+    np.testing.assert_allclose(mcmc.log_likelihood(y, yerr, y_models, np.flatnonzero(mask)), reference, rtol=1e-12)
+
+def test_numpy_fallback_matches_numba(model_cube, ion_table, monkeypatch):
+    if not mcmc._HAS_NUMBA:
+        pytest.skip('Numba is not installed')
+    
+    x = np.arange(1100., 1300., 1.)
+    y = models.get_model([6.5, -2.1, 0.2, -1.0], x, model_cube, ion_table)
+    yerr = 0.05 * y
+    mask = models.get_mask([[1150., 1160.]], x)
+    thetas = np.array([6.5, -2.1, 0.2, -1.0]) + 0.2 * np.random.default_rng(9).normal(size=(8, 4))
+    
+    def evaluate():
+        out = []
+        for precision, dtype in mcmc._precision_dtypes.items():
+            ctx = models.build_model_context(x, dtype)
+            y_sel, inv_var_sel, idx, log_err_norm = mcmc._prepare_data(y, yerr, mask, dtype)
+            y_models = models.get_model_batch(thetas, x, model_cube, ion_table, True, ctx)
+            # Evaluated twice with different numbers of walkers, so that the residual buffer is reused
+            out += [y_models, mcmc._log_likelihood(y_sel, inv_var_sel, y_models, idx, log_err_norm), 
+                    mcmc._log_likelihood(y_sel, inv_var_sel, y_models[:3], idx, log_err_norm)]
+        return out
+    
+    compiled = evaluate()
+    
+    monkeypatch.setattr(models, '_HAS_NUMBA', False)
+    monkeypatch.setattr(mcmc, '_HAS_NUMBA', False)
+    fallback = evaluate()
+    
+    for a, b in zip(compiled, fallback):
+        assert a.dtype == b.dtype
+        np.testing.assert_allclose(b, a, rtol=1e-5)
+
+def test_seeded_runs_are_reproducible(small_run):
+    chain = small_run(seed=4).get_chain()
+    
+    np.testing.assert_array_equal(small_run(seed=4, name='again').get_chain(), chain)
+    assert not np.array_equal(small_run(seed=5, name='other').get_chain(), chain)
+
+def test_fp32_run_matches_fp64(small_run):
+    fp64 = small_run(seed=4)
+    fp32 = small_run(seed=4, precision='fp32', name='fp32')
+    
+    # Both runs start from the same positions, some of which may be outside the prior
+    lp64, lp32 = fp64.get_log_prob()[0], fp32.get_log_prob()[0]
+    np.testing.assert_array_equal(np.isfinite(lp32), np.isfinite(lp64))
+    np.testing.assert_allclose(lp32[np.isfinite(lp64)], lp64[np.isfinite(lp64)], rtol=1e-5)
+
+def test_sample_stops_once_converged(tmp_path, monkeypatch):
+    nwalkers, ndim = 32, 3
+    monkeypatch.setattr(mcmc, 'initial_pos', np.random.default_rng(1).normal(size=(nwalkers, ndim)))
+    monkeypatch.setattr(mcmc, 'nsteps', 20000)
+    monkeypatch.setattr(mcmc, 'autocorr_interval', 100)
+    
+    backend = mcmc._BufferedHDFBackend(str(tmp_path / 'chain.h5'), name='test', flush_interval=100)
+    backend.reset(nwalkers, ndim)
+    sampler = emcee.EnsembleSampler(nwalkers, ndim, lambda thetas: -0.5 * np.sum(thetas**2, axis=1), backend=backend, 
+                                    moves=emcee.moves.DEMove(), vectorize=True)
+    sampler.random_state = np.random.RandomState(2).get_state()
+    
+    mcmc._sample(sampler, backend, progress=False)
+    
+    # The run ends at a convergence check, well before the full chain length, with every step on disk
+    assert backend.iteration < 20000 and backend.iteration % 100 == 0
+    assert np.all(50 * sampler.get_autocorr_time(tol=0) < backend.iteration)
+    assert emcee.backends.HDFBackend(str(tmp_path / 'chain.h5'), name='test', read_only=True).iteration == backend.iteration
+
+def test_sample_runs_full_length_without_checks(small_run):
+    assert small_run(seed=4, nsteps=50, autocorr_interval=0).iteration == 50
@@ -0,0 +1,121 @@
+import numpy as np
+import pytest
+from scipy import interpolate
+
+import sesamme.models as models
+from .conftest import write_cube
+
+#########################
+
+def _get_mask_reference(windowlist, x):
+    """
+    The original get_mask(), which finds the nearest wavelength to each window bound with argmin.
+    """
+    mask_array = np.ones(len(x))
+    
+    for k in range(len(windowlist)):
+        idxmin = (np.abs(x - windowlist[k][0])).argmin()
+        idxmax = (np.abs(x - windowlist[k][1])).argmin()
+        mask_array[np.where((x >= x[idxmin]) & (x <= x[idxmax]))] = 0
+    
+    return np.array(mask_array, dtype='bool')
+
+#########################
+
+def test_get_mask_matches_argmin():
+    rng = np.random.default_rng(42)
+    x = np.arange(1100., 1800., 0.5)
+    
+    for _ in range(50):
+        windowlist = np.sort(rng.uniform(1000., 1900., size=(rng.integers(1, 6), 2)), axis=1)
+        np.testing.assert_array_equal(models.get_mask(windowlist, x), _get_mask_reference(windowlist, x))
+
+def test_get_mask_ties():
+    # Window bounds halfway between two wavelengths go to the lower one, as with argmin
+    x = np.arange(1100., 1200., 1.)
+    windowlist = np.array([[1110.5, 1120.5], [1150., 1150.5]])
+    
+    np.testing.assert_array_equal(models.get_mask(windowlist, x), _get_mask_reference(windowlist, x))
+
+def test_nearest_ties_go_to_lower_entry(model_cube):
+    assert models._nearest_age(6.25) == ('6.0', 6.0)
+    assert models._nearest_age(7.25) == ('7.0', 7.0)
+    assert models._nearest_index([0.004, 0.008], 0.006) == 0
+    
+    np.testing.assert_array_equal(models._nearest_indices(np.array([6.0, 6.5, 7.0, 7.5]), np.array([6.25, 6.75, 7.25])), [0, 1, 2])
+
+def test_nearest_indices_single_point_grid():
+    np.testing.assert_array_equal(models._nearest_indices(np.array([0.004]), np.array([0.001, 0.004, 0.02])), [0, 0, 0])
+    assert models._nearest_index([0.004], 0.001) == 0
+
+def test_nearest_grid_batch_matches_scalar_lookups(model_cube):
+    rng = np.random.default_rng(7)
+    thetas = np.column_stack([rng.uniform(5.5, 8., 200), rng.uniform(-4.5, -1., 200), np.zeros(200), np.zeros(200)])
+    thetas[:3, 0] = [6.25, 6.75, 7.25]
+    
+    met_idx, age_idx = models._nearest_grid_batch(thetas)
+    
+    for (logt, logZ, _, _), m, a in zip(thetas, met_idx, age_idx):
+        assert models._met_keys_sorted[m] == models._nearest_metallicity(logZ)[0]
+        assert models._age_keys_sorted[a] == models._nearest_age(logt)[0]
+
+def test_precompute_nebular_matches_interp1d():
+    # Covers wavelengths off either end of nebx as well as the nodes themselves
+    x = np.concatenate([np.arange(500., 50000., 7.3), models.nebx])
+    
+    reference = interpolate.interp1d(models.nebx, np.asarray(models.sparse_nebcont, dtype=np.float64), fill_value='extrapolate')(x) / 3.83e33
+    
+    np.testing.assert_allclose(models.precompute_nebular(x), reference, rtol=1e-10)
+
+def test_get_model_uses_the_given_cube(model_cube, tmp_path):
+    file_name = str(tmp_path / 'cube_x10.fits')
+    write_cube(file_name, scale=10.)
+    
+    theta = [6.5, -2.1, 0.2, -1.0]
+    x = np.arange(1100., 1300., 1.)
+    
+    model = models.get_model(theta, x, model_cube, None, add_nebular=False)
+    
+    # Loading another cube must not change the models built from the first one
+    cube_x10 = models.load_ssp_cube(file_name)
+    
+    np.testing.assert_allclose(models.get_model(theta, x, model_cube, None, add_nebular=False), model)
+    np.testing.assert_allclose(models.get_model(theta, x, cube_x10, None, add_nebular=False), 10 * model, rtol=1e-6)
+    np.testing.assert_allclose(models.get_model_batch([theta], x, model_cube, None, add_nebular=False)[0], model)
+
+def test_wavelength_grid_is_checked(model_cube):
+    x = np.arange(1100., 1300., 1.)
+    
+    for bad_x in [x[:-1], x + 0.5, x[::-1]]:
+        with pytest.raises(ValueError):
+            models.build_model_context(bad_x)
+    
+    models.build_model_context(x)
+
+def test_models_are_built_in_the_context_precision(model_cube, ion_table):
+    x = np.arange(1100., 1300., 1.)
+    thetas = np.array([[6.5, -2.1, 0.2, -1.0], [7.1, -3.3, 0.5, 0.3]])
+    
+    fp64 = models.get_model_batch(thetas, x, model_cube, ion_table, True, models.build_model_context(x))
+    fp32 = models.get_model_batch(thetas, x, model_cube, ion_table, True, models.build_model_context(x, np.float32))
+    
+    assert fp64.dtype == np.float64 and fp32.dtype == np.float32
+    np.testing.assert_allclose(fp32, fp64, rtol=1e-6)
+
+def test_hdf5_cube_matches_fits(model_cube, ion_table, tmp_path):
+    h5_file = str(tmp_path / 'cube.h5')
+    models.convert_fits_to_hdf5(model_cube.filename(), h5_file)
+    
+    x = np.arange(1100., 1300., 1.)
+    thetas = np.array([[6.5, -2.1, 0.2, -1.0], [7.1, -3.3, 0.5, 0.3], [6.0, -1.4, 0.05, -0.5]])
+    fits_models = models.get_model_batch(thetas, x, model_cube, ion_table)
+    fits_grid = models._get_grid_state()
+    
+    # load_ssp_cube() hands HDF5 files over to load_ssp_cube_hdf5()
+    h5_cube = models.load_ssp_cube(h5_file)
+    h5_grid = models._get_grid_state()
+    
+    for name in ['metal_dict', 'age_dict', '_met_keys_sorted', '_age_keys_sorted']:
+        assert h5_grid[name] == fits_grid[name]
+    np.testing.assert_array_equal(h5_grid['_wl'], fits_grid['_wl'])
+    np.testing.assert_array_equal(models.get_model_batch(thetas, x, h5_cube, ion_table), fits_models)
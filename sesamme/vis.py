@@ -12,7 +12,7 @@ plt.rcParams.update({'font.size': 12, 'font.weight':'semibold'})
 
 ### Referencing other parts of SESAMME
 from sesamme.mcmc import ndim
-from sesamme.models import get_model, nebular_continuum, apply_ext_law, use_ext_law
+from sesamme.models import get_model, build_model_context, get_mask
 
 
 #########################
@@ -42,7 +42,7 @@ def print_stats(flat_samples):
 
 #########################
 
-def plot_samples(x, y, windowlist, flat_samples, add_nebular = True, plot_median = False, median_params = [7., -2., 0.0, 0.0], plot_random_draws = True, title = None, savefile = False, savefile_name = "example_fit"):
+def plot_samples(x, y, windowlist, flat_samples, add_nebular = True, plot_median = False, median_params = [7., -2., 0.0, 0.0], plot_random_draws = True, title = None, savefile = False, savefile_name = "example_fit", model_cube = None, ion_table = None):
     """
     A plotting function for examining the goodness-of-fit for models in the final sampler object after the MCMC run.
     
@@ -70,9 +70,16 @@ def plot_samples(x, y, windowlist, flat_samples, add_nebular = True, plot_median
         Determines whether to save figure to file; optional
     savefile_name : str
         Output file name if savefile set to True; optional
+    model_cube : FITS
+        Multi-extension FITS cube containing SSP models; optional. Defaults to the most recently loaded cube.
+    ion_table : astropy Table
+        Table object containing ionizing fluxes per SSP; required if add_nebular is True
     """
 
     
+    ### Bins that were used in the fit
+    mask = get_mask(windowlist, x)
+    
     fig, ax = plt.subplots(2, 1, sharex=True, figsize=(10,6), gridspec_kw={'height_ratios': [3, 1]})
 
     ### Plot the data and masked regions
@@ -80,15 +87,17 @@ def plot_samples(x, y, windowlist, flat_samples, add_nebular = True, plot_median
 
     ### Mark intervals that were masked during fitting
     ### Could probably done a smarter way using the mask object itself instead of windowlist
-    for k in range(len(windowlist)):
-        maskout = np.where((x >= windowlist[k][0]) & (x <= windowlist[k][1]))
-        ax[0].fill_between(x[maskout], 0, 1e6, alpha = 0.5, color='lightgrey', lw=0)
-        ax[1].fill_between(x[maskout], -10, 10, alpha = 0.5, color='lightgrey', lw=0)
+    windowlist = np.asarray(windowlist, dtype=np.float64).reshape(-1, 2)
+    masklo = np.searchsorted(x, windowlist[:, 0], side='left')
+    maskhi = np.searchsorted(x, windowlist[:, 1], side='right')
+    for lo, hi in zip(masklo, maskhi):
+        ax[0].fill_between(x[lo:hi], 0, 1e6, alpha = 0.5, color='lightgrey', lw=0)
+        ax[1].fill_between(x[lo:hi], -10, 10, alpha = 0.5, color='lightgrey', lw=0)
 
     ### Optionally plot an individual model (typically a "best fit")
     if plot_median == True:
         ### Uses the same value of add_nebular as given above
-        total_model = get_model(median_params, x, modelcube, iontable, add_nebular)
+        total_model = get_model(median_params, x, model_cube, ion_table, add_nebular)
         ax[0].step(x, total_model, color = 'royalblue', lw=1, label = 'Optimal Model', zorder=500)
     
     ### Formatting the upper panel and setting the plot title
@@ -108,18 +117,9 @@ def plot_samples(x, y, windowlist, flat_samples, add_nebular = True, plot_median
     ### Optionally plot 50 random draws from the final walker ensemble
     if plot_random_draws == True:
         np.random.seed(99)
+        ctx = build_model_context(x)
         for i in np.random.randint(0, len(flat_samples), 50):
-            t, z, ebv, amp = flat_samples[i]
-            nearest_t, nearest_z = _nearest_age(t)[0], _nearest_metallicity(z)[0]
-
-            draw_y_model = 10**(amp) * modelcube[nearest_z].data[nearest_t]
-            
-            if add_nebular == True:
-                draw_nebcont = nebular_continuum(x, [t, z, ebv, amp], iontable)
-            else:
-                draw_nebcont = 0
-            total_model = draw_y_model + draw_nebcont
-            total_model = apply_ext_law(x = x, ebv = ebv, y_model = total_model)
+            total_model = get_model(flat_samples[i], x, model_cube, ion_table, add_nebular, ctx)
 
             ax[0].step(x, total_model, alpha=  0.15, lw=1, ls=':', color='teal', zorder=0)
             ax[1].step(x[mask], (y[mask] - total_model[mask])/y[mask], ls=":", alpha=  0.05, lw=1, color='teal', zorder=1)